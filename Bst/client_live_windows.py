@@ -8,10 +8,17 @@ import numpy as np
 from mss import mss  # Для Windows - быстрее и надежнее чем PIL
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import json
 import socket
+import struct
+import tempfile
 import datetime
 import threading
+import queue
+from collections import deque
 from pathlib import Path
 import logging
 import base64
@@ -21,6 +28,314 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# urllib3 пишет предупреждение на каждый повтор подключения - ошибки логируем сами
+logging.getLogger('urllib3.connectionpool').setLevel(logging.ERROR)
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter с keep-alive пулом и статистикой переиспользования соединений.
+
+    urllib3 сам проверяет, не закрыто ли соединение сервером, и переподключается;
+    Retry(connect=...) повторяет запрос, если переподключиться сразу не удалось.
+    """
+
+    def __init__(self, pool_maxsize=2):
+        self.pools = []
+        super().__init__(pool_connections=1, pool_maxsize=pool_maxsize,
+                         max_retries=Retry(total=2, connect=2, read=0, backoff_factor=0.2))
+
+    def _track(self, pool):
+        if pool not in self.pools:
+            self.pools.append(pool)
+        return pool
+
+    def get_connection(self, *args, **kwargs):
+        return self._track(super().get_connection(*args, **kwargs))
+
+    def get_connection_with_tls_context(self, *args, **kwargs):
+        # requests >= 2.32 вызывает этот метод вместо get_connection
+        return self._track(super().get_connection_with_tls_context(*args, **kwargs))
+
+    def stats(self):
+        """Сколько запросов ушло и сколько TCP соединений для этого открыто"""
+        requests_sent = sum(pool.num_requests for pool in self.pools)
+        connections = sum(pool.num_connections for pool in self.pools)
+        return {
+            'requests': requests_sent,
+            'connections': connections,
+            'reused': max(0, requests_sent - connections),
+        }
+
+
+def create_http_session(pool_maxsize=2):
+    """Сессия requests с постоянными соединениями, живет все время работы клиента"""
+    session = requests.Session()
+    adapter = PooledHTTPAdapter(pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session, adapter
+
+
+class BandwidthManager:
+    """Token bucket исходящего канала для live-кадров.
+
+    Сегменты этой машины загружает client.py - другим процессом, поэтому
+    приоритет стрима над загрузками согласуется через файл: раз в секунду
+    менеджер записывает в rate_file текущую скорость live-трафика, а bucket
+    client.py пополняется на столько же медленнее (но не ниже своей доли
+    для загрузок). Кадр отправляется сразу, если в bucket есть токены;
+    иначе отправитель ждет, пока долг не будет оплачен.
+    """
+
+    LIVE = 'live'
+
+    def __init__(self, rate=None, rate_file=None):
+        self.rate = rate  # байт в секунду, None - без ограничения
+        self.rate_file = rate_file
+        self.burst = max(rate // 4, 64 * 1024) if rate else 0
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        self.bytes_sent = {self.LIVE: 0}
+        self.throttled_seconds = {self.LIVE: 0.0}
+        self.published_at = time.monotonic()
+        self.published_bytes = 0
+
+    def acquire(self, nbytes, priority=LIVE):
+        """Ждет, пока nbytes можно отправить"""
+        delay = 0.0
+        with self.lock:
+            if self.rate:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens <= 0:
+                    delay = -self.tokens / self.rate
+                self.tokens -= nbytes
+            self.bytes_sent[priority] += nbytes
+            self.throttled_seconds[priority] += delay
+            self._publish_rate()
+        if delay:
+            time.sleep(delay)
+
+    def _publish_rate(self):
+        """Скорость live-трафика за последнюю секунду - в rate_file для client.py"""
+        now = time.monotonic()
+        if not self.rate_file or now - self.published_at < 1:
+            return
+        sent = self.bytes_sent[self.LIVE]
+        report = {'bytes_per_second': (sent - self.published_bytes) / (now - self.published_at),
+                  'time': time.time()}
+        self.published_at, self.published_bytes = now, sent
+        try:
+            tmp = Path(f"{self.rate_file}.tmp")
+            tmp.write_text(json.dumps(report))
+            tmp.replace(self.rate_file)
+        except OSError as e:
+            logger.debug(f"Live rate report error: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {'bytes': self.bytes_sent[self.LIVE],
+                    'throttled_s': round(self.throttled_seconds[self.LIVE], 1)}
+
+
+
+# Общий с client.py файл отчета о скорости live-трафика
+DEFAULT_LIVE_RATE_FILE = Path(tempfile.gettempdir()) / 'screen_recorder_live_rate.json'
+
+
+class LatestQueue:
+    """Ограниченная очередь с политикой drop-oldest: при переполнении
+    выбрасывается самый старый элемент, put() никогда не блокируется"""
+
+    def __init__(self, maxsize):
+        self.items = deque(maxlen=maxsize)
+        self.cond = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self.items:
+                self.cond.wait(timeout)
+            return self.items.popleft() if self.items else None
+
+
+class FramePool:
+    """Небольшой пул кадровых буферов одного размера.
+
+    Буфер берется через acquire(), а после записи/кодирования кадра
+    возвращается через release() и используется для следующего кадра,
+    вместо выделения нового массива на каждый кадр.
+    """
+
+    def __init__(self, max_buffers=4):
+        self.max_buffers = max_buffers
+        self.free = {}
+        self.lock = threading.Lock()
+        self.allocated = 0
+
+    def acquire(self, shape):
+        with self.lock:
+            buffers = self.free.get(shape)
+            if buffers:
+                return buffers.pop()
+            self.allocated += 1
+        return np.empty(shape, dtype=np.uint8)
+
+    def release(self, frame):
+        with self.lock:
+            buffers = self.free.setdefault(frame.shape, [])
+            if len(buffers) < self.max_buffers:
+                buffers.append(frame)
+
+
+class FramePipeline:
+    """Конвейер захват -> кодирование/запись -> отправка.
+
+    Поток захвата только кладёт кадры в encode_queue. Стадия кодирования пишет
+    кадр в VideoWriter и, если нужно, кодирует JPEG для стрима. Стадия отправки
+    шлёт JPEG на сервер. Очередь стрима - drop-oldest, поэтому медленная сеть
+    теряет устаревшие кадры, а не тормозит захват.
+    """
+
+    def __init__(self, recorder, pool, queue_size=20, live_queue_size=2):
+        self.recorder = recorder
+        self.pool = pool
+        self.encode_queue = queue.Queue(maxsize=queue_size)
+        self.send_queue = LatestQueue(live_queue_size)
+        self.dropped_frames = 0
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.threads = [
+            threading.Thread(target=self._encode_loop, name="encoder", daemon=True),
+            threading.Thread(target=self._send_loop, name="sender", daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        self.encode_queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout=5)
+        self.threads = []
+
+    def submit(self, writer, frame, write=True, push_live=False, timeout=None, repeat=1):
+        """Передает кадр стадии кодирования. False - очередь полна, кадр потерян.
+        repeat - сколько раз записать кадр (заполнение пропущенных слотов)"""
+        try:
+            self.encode_queue.put((writer, frame, write, push_live, repeat), timeout=timeout)
+            return True
+        except queue.Full:
+            self.dropped_frames += 1
+            return False
+
+    def flush(self):
+        """Ждет, пока все поставленные кадры будут записаны"""
+        self.encode_queue.join()
+
+    def _encode_loop(self):
+        while True:
+            item = self.encode_queue.get()
+            try:
+                if item is None:
+                    break
+                writer, frame, write, push_live, repeat = item
+                if write:
+                    for _ in range(repeat):
+                        writer.write(frame)
+                if push_live:
+                    self.send_queue.put(self.recorder.encode_frame_for_stream(frame))
+                # Кадр больше не нужен - буфер возвращается в пул
+                self.pool.release(frame)
+            except Exception as e:
+                logger.error(f"Encoder stage error: {e}")
+            finally:
+                self.encode_queue.task_done()
+
+    def _send_loop(self):
+        # Основной путь - постоянный канал /api/ingest. Если сервер его не
+        # поддерживает или канал оборвался, кадры идут по одному на
+        # /api/upload_frame, а канал переоткрывается через 30 секунд
+        channel_retry_at = 0.0
+        while self.running:
+            if time.monotonic() >= channel_retry_at:
+                opened = time.monotonic()
+                try:
+                    self.recorder.stream_frames(self._channel_frames())
+                except Exception as e:
+                    logger.debug(f"Live channel error: {e}")
+                if not self.running:
+                    break
+                # Долго проработавший канал (перезапуск сервера) переоткрываем сразу
+                if time.monotonic() - opened < 30:
+                    logger.info("Live channel unavailable, sending frames one per request")
+                    channel_retry_at = time.monotonic() + 30
+            frame_bytes = self.send_queue.get(timeout=0.5)
+            if frame_bytes is not None:
+                self.recorder.send_frame_for_stream(frame_bytes)
+
+    def _channel_frames(self):
+        """Тело постоянного канала: кадры [4 байта длины][JPEG], пока конвейер работает"""
+        while self.running:
+            frame_bytes = self.send_queue.get(timeout=0.5)
+            if frame_bytes is not None:
+                self.recorder.bandwidth.acquire(4 + len(frame_bytes), BandwidthManager.LIVE)
+                yield struct.pack('>I', len(frame_bytes)) + frame_bytes
+
+
+class FrameScheduler:
+    """Планировщик кадров по абсолютным дедлайнам на monotonic часах.
+
+    Кадр n снимается в момент start + n / fps, поэтому время обработки кадра
+    не сдвигает расписание. Если захват опоздал, прошедшие слоты считаются
+    потерянными (dropped) - их можно заполнить повтором кадра, чтобы число
+    кадров в файле совпадало с fps контейнера.
+    """
+
+    def __init__(self, fps, duration=None):
+        self.interval = 1.0 / fps
+        self.total_frames = int(fps * duration) if duration else None
+        self.start = time.monotonic()
+        self.next_frame = 0
+        self.dropped = 0
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def done(self):
+        if self.total_frames is not None:
+            return self.next_frame >= self.total_frames
+        return False
+
+    def wait(self):
+        """Ждет дедлайн следующего кадра. Возвращает число пропущенных слотов"""
+        now = time.monotonic()
+        deadline = self.start + self.next_frame * self.interval
+        missed = 0
+        if now < deadline:
+            time.sleep(deadline - now)
+        else:
+            missed = int((now - deadline) / self.interval)
+            if self.total_frames is not None:
+                missed = min(missed, max(0, self.total_frames - self.next_frame - 1))
+        self.next_frame += missed + 1
+        self.dropped += missed
+        return missed
+
 
 class ScreenRecorder:
     def __init__(self, server_ip=None, upload_interval=300):  # 5 минут
@@ -46,8 +361,17 @@ class ScreenRecorder:
         self.sct = mss()
         self.monitor = self.sct.monitors[1]  # Берем основной монитор
         
-        # Поток для стрима
-        self.streaming_thread = None
+        # Конвейер кодирования и отправки кадров, буферы кадров переиспользуются
+        self.frame_pool = FramePool(max_buffers=4)
+        self.pipeline = FramePipeline(self, self.frame_pool, queue_size=self.fps * 2)
+        
+        # Постоянное keep-alive соединение с сервером для стрима
+        self.http, self.http_adapter = create_http_session()
+        # Темп live-кадров: UPLOAD_RATE_KBPS - тот же лимит канала, что у client.py
+        rate_kbps = int(self.load_config_or_env('UPLOAD_RATE_KBPS') or '0')
+        self.bandwidth = BandwidthManager(
+            rate=rate_kbps * 1000 // 8 or None,
+            rate_file=self.load_config_or_env('LIVE_RATE_FILE') or DEFAULT_LIVE_RATE_FILE)
         
         logger.info(f"Screen Recorder initialized for machine: {self.machine_id}")
         logger.info(f"Server: http://{self.server_ip}:{self.server_port}")
@@ -102,26 +426,44 @@ class ScreenRecorder:
             # Захватываем экран используя mss
             screenshot = self.sct.grab(self.monitor)
             
-            # Конвертируем mss.Screenshot в numpy array
-            img = np.array(screenshot)
+            # Буфер mss (BGRA) читаем напрямую, без копии в новый массив
+            bgra = np.frombuffer(screenshot.raw, dtype=np.uint8).reshape(
+                screenshot.height, screenshot.width, 4)
             
-            # mss возвращает BGRA, конвертируем в RGB
-            img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
+            # VideoWriter и imencode ждут BGR - конвертируем сразу в буфер из пула
+            img = self.frame_pool.acquire((screenshot.height, screenshot.width, 3))
+            cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR, dst=img)
             
             return img
         except Exception as e:
             logger.error(f"Screen capture error: {e}")
             # Возвращаем черный кадр при ошибке
             width, height = self.get_screen_size()
-            return np.zeros((height, width, 3), dtype=np.uint8)
+            img = self.frame_pool.acquire((height, width, 3))
+            img.fill(0)
+            return img
+    
+    def encode_frame_for_stream(self, frame):
+        """Конвертирует frame в JPEG для live стрима"""
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        return buffer.tobytes()
     
-    def send_frame_for_stream(self, frame):
-        """Отправляет кадр на сервер для live стрима"""
+    def stream_frames(self, frames):
+        """Постоянный канал трансляции: одно chunked POST-тело на все кадры.
+        Возвращается, когда канал закрыт"""
+        response = self.http.post(
+            f"http://{self.server_ip}:{self.server_port}/api/ingest",
+            params={'machine_id': self.machine_id},
+            data=frames,
+            timeout=(5, 30),
+            headers={'X-Machine-Id': self.machine_id, 'Content-Type': 'application/octet-stream'}
+        )
+        if response.status_code != 200:
+            logger.debug(f"Live channel rejected: {response.status_code}")
+    
+    def send_frame_for_stream(self, frame_bytes):
+        """Отправляет JPEG кадр на сервер для live стрима"""
         try:
-            # Конвертируем frame в JPEG
-            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-            frame_bytes = buffer.tobytes()
-            
             # Отправляем на сервер
             url = f"http://{self.server_ip}:{self.server_port}/api/upload_frame"
             headers = {
@@ -132,7 +474,9 @@ class ScreenRecorder:
                 'machine_id': self.machine_id
             }
             
-            response = requests.post(
+            # Отправляем в темпе, который позволяет канал
+            self.bandwidth.acquire(len(frame_bytes), BandwidthManager.LIVE)
+            response = self.http.post(
                 url,
                 data=frame_bytes,
                 headers=headers,
@@ -163,31 +507,51 @@ class ScreenRecorder:
             logger.error(f"Failed to open video writer for {filepath}")
             return
         
-        start_time = time.time()
         segment_duration = self.upload_interval  # 5 минут
+        # Контроль FPS по абсолютным дедлайнам, длительность - по часам
+        scheduler = FrameScheduler(self.fps, segment_duration)
         
         logger.info(f"Started recording segment: {filename}")
+        # Незаписанные слоты (пропущенные дедлайны, неудачный захват, полная
+        # очередь) заполняет следующий кадр, ушедший в конвейер
+        pending = 0
         
-        while time.time() - start_time < segment_duration:
+        while not scheduler.done():
             if not self.is_recording:
                 break
             
+            pending += scheduler.wait() + 1
             frame = self.capture_screen()
             
             if frame is not None:
-                # Записываем кадр в видео
-                out.write(frame)
-                
-                # Отправляем каждый 2-й кадр для live стрима
-                if self.is_streaming and self.frame_count % 2 == 0:
-                    self.send_frame_for_stream(frame)
+                # Запись в видео и отправка каждого 2-го кадра идут в потоках конвейера.
+                # Пропущенные слоты заполняем повтором кадра
+                push_live = self.is_streaming and self.frame_count % 2 == 0
+                if self.pipeline.submit(out, frame, push_live=push_live,
+                                        timeout=1.0 / self.fps, repeat=pending):
+                    pending = 0
+                else:
+                    self.frame_pool.release(frame)
                 
                 self.frame_count += 1
-            
-            # Контроль FPS
-            time.sleep(1.0 / self.fps)
         
+        # Дописываем кадры, которые еще в очереди кодировщика
+        self.pipeline.flush()
         out.release()
+        if scheduler.dropped:
+            logger.info(f"Missed frame deadlines: {scheduler.dropped}")
+        if self.pipeline.dropped_frames or self.pipeline.send_queue.dropped:
+            logger.info(f"Dropped frames: recording={self.pipeline.dropped_frames}, "
+                        f"live={self.pipeline.send_queue.dropped}")
+            self.pipeline.dropped_frames = self.pipeline.send_queue.dropped = 0
+        usage = self.bandwidth.stats()
+        if usage['bytes']:
+            logger.info(f"Live traffic: {usage['bytes'] / (1024*1024):.1f} MB "
+                        f"(throttled {usage['throttled_s']}s)")
+        stats = self.http_adapter.stats()
+        if stats['requests']:
+            logger.info(f"HTTP connections: {stats['connections']} for {stats['requests']} requests "
+                        f"({stats['reused']} reused)")
         logger.info(f"Finished recording segment: {filename}")
         
         # Загружаем видео на сервер (опционально, если нужно)
@@ -201,6 +565,7 @@ class ScreenRecorder:
         
         self.is_recording = True
         self.frame_count = 0
+        self.pipeline.start()
         
         def recording_loop():
             while self.is_recording:
@@ -218,6 +583,8 @@ class ScreenRecorder:
         if self.video_writer:
             self.video_writer.release()
             self.video_writer = None
+        self.pipeline.stop()
+        self.http.close()
         logger.info("Recording stopped")
     
     def run(self):
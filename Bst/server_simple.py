@@ -1,55 +1,406 @@
 #!/usr/bin/env python3
 """Простой сервер с MJPEG стримом"""
-from flask import Flask, Response, render_template_string, request, send_file
+from flask import Flask, Response, jsonify, render_template_string, request, send_file
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote, urlsplit
+import asyncio
+import datetime
+import heapq
+import io
+import itertools
+import os
+import re
+import socket
+import sqlite3
+import sys
 import time
 import threading
 import cv2
+import numpy as np
 import shutil
+import struct
 import subprocess
 
 app = Flask(__name__)
 VIDEOS = Path("temp_recordings")
 VIDEOS.mkdir(exist_ok=True)
 
-# Кадры прямой трансляции по машинам
-machine_id_to_last_frame = {}
-machine_id_to_lock = {}
+# Размеры live-кадра для зрителей (?size=): ширина в пикселях, full - как прислал клиент
+RENDITION_WIDTHS = {'thumb': 320, 'medium': 960}
+RENDITION_QUALITY = 70
+# В обычном (потоковом) режиме каждый MJPEG-зритель держит поток Flask, поэтому
+# превью на главной - отдельные JPEG (/snapshot.jpg), которые страница
+# перезапрашивает раз в THUMB_REFRESH_MS. С ASYNC_LIVE превью - MJPEG-потоки
+ASYNC_LIVE = os.getenv('ASYNC_LIVE', '').lower() == 'true'
+THUMB_REFRESH_MS = 2000
 
-def get_machine_lock(machine_id: str) -> threading.Lock:
-    if machine_id not in machine_id_to_lock:
-        machine_id_to_lock[machine_id] = threading.Lock()
-    return machine_id_to_lock[machine_id]
+def rendition_size(value) -> str:
+    return value if value in RENDITION_WIDTHS else 'full'
+
+def scale_jpeg(frame: bytes, width: int) -> bytes:
+    """JPEG, уменьшенный до ширины width (меньшие кадры не увеличиваем)"""
+    image = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None or image.shape[1] <= width:
+        return frame
+    height = max(1, round(image.shape[0] * width / image.shape[1]))
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, RENDITION_QUALITY])
+    return buffer.tobytes()
+
+class FrameSlot:
+    """Последний кадр live-стрима с номером (publish/subscribe).
+    
+    Зрители ждут кадр новее уже показанного: просыпаются ровно когда он
+    пришел и никогда не получают один кадр дважды. Потоки Flask ждут на
+    Condition, корутины асинхронного режима - на asyncio.Future.
+    
+    Уменьшенные копии кадра (renditions) считаются лениво: первый зритель
+    нужного размера сжимает новый кадр, остальные получают готовый JPEG.
+    Размер, который никто не смотрит, не считается вовсе.
+    """
+    
+    def __init__(self):
+        self.frame = None
+        self.seq = 0
+        self.published_at = 0.0
+        self.condition = threading.Condition()
+        self.async_waiters = set()
+        self.renditions = {}
+        self.rendition_locks = {size: threading.Lock() for size in RENDITION_WIDTHS}
+    
+    def publish(self, frame: bytes):
+        with self.condition:
+            self.frame = frame
+            self.seq += 1
+            self.published_at = time.monotonic()
+            self.condition.notify_all()
+            waiters, self.async_waiters = self.async_waiters, set()
+        for waiter in waiters:
+            waiter.get_loop().call_soon_threadsafe(wake_async_waiter, waiter)
+    
+    def latest(self):
+        return self.frame, self.seq, self.published_at
+    
+    def rendition(self, size: str, seq: int, frame: bytes) -> bytes:
+        """Кадр номер seq в размере size, один раз на кадр для всех зрителей"""
+        if size not in RENDITION_WIDTHS:
+            return frame
+        with self.rendition_locks[size]:
+            cached = self.renditions.get(size)
+            if cached is not None and cached[0] == seq:
+                return cached[1]
+            jpeg = scale_jpeg(frame, RENDITION_WIDTHS[size])
+            # Отставший зритель не вытесняет из кэша более новый кадр
+            if cached is None or cached[0] < seq:
+                self.renditions[size] = (seq, jpeg)
+            return jpeg
+    
+    def wait(self, seq: int, timeout: float):
+        """(кадр, номер, время публикации) новее seq; по таймауту - текущие"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq != seq, timeout)
+            return self.latest()
+    
+    async def wait_async(self, seq: int, timeout: float):
+        with self.condition:
+            if self.seq != seq:
+                return self.latest()
+            waiter = asyncio.get_running_loop().create_future()
+            self.async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            with self.condition:
+                self.async_waiters.discard(waiter)
+        with self.condition:
+            return self.latest()
+
+def wake_async_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+# Кадры прямой трансляции по машинам (ключ - stream_key)
+machine_id_to_slot = {}
+machine_id_to_slot_guard = threading.Lock()
+
+def get_frame_slot(key: str) -> FrameSlot:
+    with machine_id_to_slot_guard:
+        return machine_id_to_slot.setdefault(key, FrameSlot())
+
+def has_live_frame(key: str) -> bool:
+    slot = machine_id_to_slot.get(key)
+    return slot is not None and slot.frame is not None
+
+# Буфер отправки сокета MJPEG-зрителя: у медленного зрителя в очереди
+# остается не больше пары кадров, а не секунды устаревшего видео
+MJPEG_SEND_BUFFER = 64 * 1024
+
+class ViewerStats:
+    """Статистика одного MJPEG-зрителя.
+    
+    Почтовый ящик зрителя - FrameSlot и номер последнего отправленного кадра:
+    пока зритель пишет в сокет, новые кадры заменяют друг друга, а после
+    записи он получает самый свежий. Пропущенные кадры считаются в dropped,
+    lag - время от публикации кадра до окончания его записи в сокет зрителя.
+    """
+    
+    ids = itertools.count(1)
+    
+    def __init__(self, key: str, remote: str, size: str = 'full'):
+        self.id = next(self.ids)
+        self.key = key
+        self.remote = remote
+        self.size = size
+        self.connected_at = time.time()
+        self.sent = 0
+        self.dropped = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+    
+    def delivered(self, seq: int, new_seq: int, published_at: float):
+        self.sent += 1
+        # Первый кадр при подключении может быть старым - это не задержка зрителя
+        if seq:
+            self.dropped += max(0, new_seq - seq - 1)
+            self.lag = time.monotonic() - published_at
+            self.max_lag = max(self.max_lag, self.lag)
+    
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'stream': self.key,
+            'remote': self.remote,
+            'size': self.size,
+            'connected_s': round(time.time() - self.connected_at),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'lag_ms': round(self.lag * 1000, 1),
+            'max_lag_ms': round(self.max_lag * 1000, 1),
+        }
+
+live_viewers = {}
+live_viewers_guard = threading.Lock()
+
+def register_viewer(key: str, remote: str, size: str = 'full') -> ViewerStats:
+    stats = ViewerStats(key, remote, size)
+    with live_viewers_guard:
+        live_viewers[stats.id] = stats
+    return stats
+
+def unregister_viewer(stats: ViewerStats):
+    with live_viewers_guard:
+        live_viewers.pop(stats.id, None)
+
+def limit_send_buffer(sock):
+    if sock is not None:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MJPEG_SEND_BUFFER)
+        except OSError:
+            pass
+
+def stream_key(machine_id: str, monitor=None) -> str:
+    """Ключ live-стрима: machine_id, а для отдельного монитора - machine_id@номер"""
+    return machine_id if monitor is None else f"{machine_id}@{monitor}"
+
+def split_stream_key(key: str):
+    """Обратно к (machine_id, monitor)"""
+    machine_id, _, monitor = key.partition('@')
+    return machine_id, int(monitor) if monitor.isdigit() else None
+
+# Максимальный размер кадра в постоянном канале /api/ingest
+MAX_INGEST_FRAME = 16 * 1024 * 1024
+
+def read_exact(stream, size: int):
+    """Читает ровно size байт; b'' - поток закончился до начала, None - оборвался посередине"""
+    data = bytearray()
+    while len(data) < size:
+        block = stream.read(size - len(data))
+        if not block:
+            return None if data else b''
+        data += block
+    return bytes(data)
+
+# Черный кадр 1x1 для MJPEG, если нет ни live-кадров, ни записей
+BLACK_JPEG = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x01\x00H\x00H\x00\x00\xff\xdb\x00C\x00\x08\x06\x06\x07\x06\x05\x08\x07\x07\x07\t\t\x08\n\x0c\x14\r\x0c\x0b\x0b\x0c\x19\x12\x13\x0f\x14\x1d\x1a\x1f\x1e\x1d\x1a\x1c\x1c $.\' ",#\x1c\x1c(7),01444\x1f\'9=82<.342\xff\xc0\x00\x11\x08\x00\x01\x00\x01\x01\x01\x11\x01\x02\x11\x01\xff\xc4\x00\x14\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x08\xff\xc4\x00\x14\x10\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xff\xda\x00\x08\x01\x01\x00\x00?\x00\xaa\xff\xd9'
+
+# Индекс записей в SQLite. Файлы в VIDEOS пишут другие процессы, поэтому
+# перед выдачей списка проверяется только mtime папок машин: заново
+# просматриваются папки, где файлы добавили, удалили или переименовали.
+# Дозапись файла mtime папки не меняет, поэтому файлы, менявшиеся за
+# последние INDEX_SETTLE секунд или без длительности, проверяются stat отдельно.
+# База лежит в отдельной папке, чтобы ее журнал не менял mtime VIDEOS
+RECORDINGS_DB = VIDEOS / "_index" / "recordings.db"
+RECORDINGS_DB.parent.mkdir(exist_ok=True)
+SEGMENT_TIME_RE = re.compile(r'(\d{8}_\d{6})\.mp4$')
+INDEX_SETTLE = 300
+recordings_lock = threading.Lock()
+recordings_refresh_lock = threading.Lock()
+recordings_db = sqlite3.connect(str(RECORDINGS_DB), check_same_thread=False)
+recordings_db.executescript("""
+    CREATE TABLE IF NOT EXISTS recordings (
+        machine_id TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        start_time REAL,
+        end_time REAL,
+        duration REAL,
+        codec TEXT,
+        width INTEGER,
+        height INTEGER,
+        PRIMARY KEY (machine_id, filename)
+    );
+    CREATE INDEX IF NOT EXISTS recordings_by_start ON recordings (machine_id, start_time);
+    CREATE TABLE IF NOT EXISTS recording_folders (
+        machine_id TEXT PRIMARY KEY,
+        mtime REAL NOT NULL
+    );
+""")
+
+def query_recordings(sql: str, params=()):
+    with recordings_lock:
+        return recordings_db.execute(sql, params).fetchall()
+
+def machine_folder(machine_id: str) -> Path:
+    return VIDEOS / machine_id if machine_id != 'default' else VIDEOS
+
+def probe_video(path: Path) -> dict:
+    """Длительность, кодек и размер кадра из заголовка mp4"""
+    cap = cv2.VideoCapture(str(path))
+    try:
+        if not cap.isOpened():
+            return {}
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+        return {
+            'duration': frames / fps if fps > 0 and frames > 0 else None,
+            'codec': fourcc.to_bytes(4, 'little').decode('latin-1').strip('\x00 ') or None,
+            'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or None,
+            'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or None,
+        }
+    finally:
+        cap.release()
+
+def recording_start(filename: str, mtime: float, duration) -> float:
+    """Начало записи: время из имени сегмента (..._20240101_120000.mp4),
+    иначе время изменения файла минус длительность"""
+    match = SEGMENT_TIME_RE.search(filename)
+    if match:
+        try:
+            return datetime.datetime.strptime(match.group(1), '%Y%m%d_%H%M%S').timestamp()
+        except ValueError:
+            pass
+    return mtime - (duration or 0)
+
+def recording_row(machine_id: str, path: Path, st) -> tuple:
+    """Строка индекса для файла записи (с разбором заголовка mp4)"""
+    meta = probe_video(path)
+    duration = meta.get('duration')
+    start = recording_start(path.name, st.st_mtime, duration)
+    return (machine_id, path.name, st.st_size, st.st_mtime, start,
+            start + duration if duration else st.st_mtime, duration,
+            meta.get('codec'), meta.get('width'), meta.get('height'))
+
+def scan_recording_folder(machine_id: str, folder: Path):
+    """Сверка одной папки с индексом: новые и измененные файлы
+    индексируются, исчезнувшие удаляются"""
+    known = {filename: (size, mtime) for filename, size, mtime in query_recordings(
+        "SELECT filename, size, mtime FROM recordings WHERE machine_id = ?", (machine_id,))}
+    rows = []
+    for entry in os.scandir(folder):
+        if not entry.name.endswith('.mp4') or not entry.is_file():
+            continue
+        st = entry.stat()
+        if known.pop(entry.name, None) == (st.st_size, st.st_mtime):
+            continue
+        rows.append(recording_row(machine_id, Path(entry.path), st))
+    with recordings_lock, recordings_db:
+        recordings_db.executemany("INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        recordings_db.executemany("DELETE FROM recordings WHERE machine_id = ? AND filename = ?",
+                                  [(machine_id, filename) for filename in known])
+    return len(rows), len(known)
+
+def revalidate_unsettled_recordings():
+    """Дописываемый сегмент не меняет mtime папки: файлы, которые недавно
+    менялись или еще не разобрались (duration IS NULL), проверяются stat
+    по отдельности и переиндексируются, если изменились"""
+    rows, removed = [], []
+    for machine_id, filename, size, mtime in query_recordings(
+            "SELECT machine_id, filename, size, mtime FROM recordings WHERE duration IS NULL OR mtime > ?",
+            (time.time() - INDEX_SETTLE,)):
+        path = machine_folder(machine_id) / filename
+        try:
+            st = path.stat()
+        except OSError:
+            removed.append((machine_id, filename))
+            continue
+        if (st.st_size, st.st_mtime) != (size, mtime):
+            rows.append(recording_row(machine_id, path, st))
+    if rows or removed:
+        with recordings_lock, recordings_db:
+            recordings_db.executemany("INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            recordings_db.executemany("DELETE FROM recordings WHERE machine_id = ? AND filename = ?", removed)
+
+def refresh_recordings_index():
+    """Один stat на папку машины; папки с новым mtime просматриваются заново,
+    в остальных - только недописанные файлы"""
+    with recordings_refresh_lock:
+        folders = {'default': VIDEOS}
+        for entry in os.scandir(VIDEOS):
+            if entry.is_dir() and not entry.name.startswith('_') and entry.name != 'default':
+                folders[entry.name] = Path(entry.path)
+        known = dict(query_recordings("SELECT machine_id, mtime FROM recording_folders"))
+        for machine_id, folder in folders.items():
+            mtime = folder.stat().st_mtime
+            if known.pop(machine_id, None) == mtime:
+                continue
+            updated, removed = scan_recording_folder(machine_id, folder)
+            with recordings_lock, recordings_db:
+                recordings_db.execute("INSERT OR REPLACE INTO recording_folders VALUES (?, ?)", (machine_id, mtime))
+            if updated or removed:
+                print(f"[INDEX] {machine_id}: обновлено {updated}, удалено {removed}")
+        # Папку машины удалили целиком
+        with recordings_lock, recordings_db:
+            for machine_id in known:
+                recordings_db.execute("DELETE FROM recordings WHERE machine_id = ?", (machine_id,))
+                recordings_db.execute("DELETE FROM recording_folders WHERE machine_id = ?", (machine_id,))
+        revalidate_unsettled_recordings()
+
+def latest_recording(machine_id: str, monitor=None):
+    """Последняя запись машины (или монитора) для повтора вместо live-стрима"""
+    refresh_recordings_index()
+    pattern = f'*_mon{monitor}_*.mp4' if monitor is not None else '*.mp4'
+    rows = query_recordings("SELECT filename FROM recordings WHERE machine_id = ? AND filename GLOB ? "
+                            "ORDER BY filename DESC LIMIT 1", (machine_id, pattern))
+    return machine_folder(machine_id) / rows[0][0] if rows else None
 
 @app.route('/')
 def index():
     # Список машин = подкаталоги, активные live-стримы и mp4 на верхнем уровне
     machines_dict = {}
     
-    # Добавляем машины из папок
-    for p in sorted(VIDEOS.iterdir(), key=lambda x: x.name):
-        if p.is_dir() and not p.name.startswith('_'):
-            count = len(list(p.glob('*.mp4')))
-            size = sum(v.stat().st_size for v in p.glob('*.mp4'))
-            machines_dict[p.name] = (count, size)
+    # Добавляем машины из папок (по индексу записей)
+    refresh_recordings_index()
+    for (machine_id,) in query_recordings("SELECT machine_id FROM recording_folders WHERE machine_id != 'default'"):
+        machines_dict[machine_id] = (0, 0)
+    for machine_id, count, size in query_recordings(
+            "SELECT machine_id, COUNT(*), SUM(size) FROM recordings GROUP BY machine_id"):
+        # Файлы без папки считаем как Default
+        machines_dict[machine_id] = (count, size)
     
-    # Добавляем активные live-стримы (даже если нет видео)
-    for machine_id in machine_id_to_last_frame.keys():
+    # Добавляем активные live-стримы (даже если нет видео).
+    # Мониторы одной машины показываем отдельными кнопками LIVE
+    live_monitors = {}
+    live_streams = {}
+    for key in [k for k, slot in list(machine_id_to_slot.items()) if slot.frame is not None]:
+        machine_id, monitor = split_stream_key(key)
+        live_streams.setdefault(machine_id, []).append(monitor)
+        if monitor is not None:
+            live_monitors.setdefault(machine_id, []).append(monitor)
         if machine_id and machine_id != 'default':
-            if machine_id not in machines_dict:
-                machines_dict[machine_id] = (0, 0)
-            # Обновляем счетчики если есть папка
-            folder = VIDEOS / machine_id
-            if folder.exists():
-                count = len(list(folder.glob('*.mp4')))
-                size = sum(v.stat().st_size for v in folder.glob('*.mp4'))
-                machines_dict[machine_id] = (count, size)
-    
-    # Файлы без папки считаем как Default
-    root_videos = list(VIDEOS.glob('*.mp4'))
-    if root_videos:
-        size = sum(v.stat().st_size for v in root_videos)
-        machines_dict["default"] = (len(root_videos), size)
+            machines_dict.setdefault(machine_id, (0, 0))
     
     machines = [(k, machines_dict[k][0], machines_dict[k][1]) for k in sorted(machines_dict.keys())]
     
@@ -71,6 +422,7 @@ def index():
         }}
         @keyframes pulse {{0%,100%{{opacity:1;transform:scale(1)}} 50%{{opacity:0.8;transform:scale(1.05)}}}}
         .status{{background:#0f0;color:white;padding:10px;border-radius:5px;margin:10px 0}}
+        .thumb{{width:320px;margin:0 10px 10px 0;border:2px solid #f00;border-radius:6px;vertical-align:top}}
     </style>
     </head>
     <body>
@@ -83,15 +435,42 @@ def index():
         <h2>🖥️ Машины ({len(machines)}):</h2>
     """
     for mid, count, size in machines:
+        if mid in live_monitors:
+            live_links = ' '.join(f'<a href="/live/{mid}?monitor={m}" class="live-btn">🔴 LIVE #{m}</a>'
+                                  for m in sorted(live_monitors[mid]))
+        else:
+            live_links = f'<a href="/live/{mid}" class="live-btn">🔴 LIVE</a>'
+        # Превью живых экранов - уменьшенный кадр, общий для всех зрителей
+        thumbs = ''
+        for m in sorted(live_streams.get(mid, []), key=lambda m: -1 if m is None else m):
+            monitor_arg = '' if m is None else f'monitor={m}&'
+            if ASYNC_LIVE:
+                thumb = f'<img class="thumb" src="/stream.mjpg?machine_id={mid}&{monitor_arg}size=thumb">'
+            else:
+                thumb = f'<img class="thumb" data-poll src="/snapshot.jpg?machine_id={mid}&{monitor_arg}size=thumb">'
+            thumbs += f'<a href="/live/{mid}?{monitor_arg}size=full">{thumb}</a>'
         html += f"""
         <div class="video">
             <h3>🖥️ {mid}</h3>
             <div class="info">📁 Файлов: {count} | 💾 Размер: {size/1024/1024:.2f} MB</div>
-            <a href="/live/{mid}" class="live-btn">🔴 LIVE</a>
+            {thumbs}
+            {live_links}
             <a href="/list/{mid}" class="live-btn" style="background:#4CAF50">📼 Записи</a>
         </div>
         """
     
+    if not ASYNC_LIVE:
+        # Следующий кадр превью запрашивается, когда предыдущий загрузился
+        html += """
+        <script>
+            document.querySelectorAll('img[data-poll]').forEach(img => {
+                const base = img.src;
+                const next = () => setTimeout(() => { img.src = base + '&t=' + Date.now(); }, %d);
+                img.onload = next;
+                img.onerror = next;
+            });
+        </script>
+        """ % THUMB_REFRESH_MS
     html += "</body></html>"
     return html
 
@@ -114,7 +493,7 @@ def live_view(machine_id: str = 'default'):
         <div class="container">
             <h1>🔴 ПРЯМАЯ ТРАНСЛЯЦИЯ</h1>
             <div class="status" id="status">● LIVE</div>
-            <img id="frame" src="/stream.mjpg?machine_id={{ machine_id }}" style="width:100%;max-width:100%">
+            <img id="frame" src="/stream.mjpg?machine_id={{ machine_id }}{% if monitor is not none %}&monitor={{ monitor }}{% endif %}&size={{ size }}" style="width:100%;max-width:100%">
             
             <script>
                 let lastUpdate = Date.now();
@@ -143,32 +522,43 @@ def live_view(machine_id: str = 'default'):
         </div>
     </body></html>
     """
-    return render_template_string(html, machine_id=machine_id)
+    monitor = request.args.get('monitor', type=int)
+    size = rendition_size(request.args.get('size'))
+    return render_template_string(html, machine_id=machine_id, monitor=monitor, size=size)
 
 @app.route('/stream.mjpg')
 def stream_mjpg():
-    """MJPEG stream - показывает последнее видео если нет live стрима"""
+    """MJPEG stream - показывает последнее видео если нет live стрима.
+    ?size=thumb|medium|full - размер кадра (по умолчанию full)"""
     machine_id = request.args.get('machine_id', 'default')
+    monitor = request.args.get('monitor', type=int)
+    size = rendition_size(request.args.get('size'))
+    key = stream_key(machine_id, monitor)
+    remote = request.remote_addr
+    limit_send_buffer(request.environ.get('werkzeug.socket'))
 
     def generate():
-        lock = get_machine_lock(machine_id)
-        last_frame = machine_id_to_last_frame.get(machine_id)
         # Если есть live кадр - используем его, иначе показываем последнее видео машины
-        if last_frame:
-            while True:
-                with lock:
-                    lf = machine_id_to_last_frame.get(machine_id)
-                if lf:
-                    yield b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + lf + b'\r\n'
-                    time.sleep(0.1)  # 10 FPS
-                else:
-                    break
+        if has_live_frame(key):
+            # Просыпаемся только на новый кадр, каждый кадр уходит зрителю один раз
+            slot = get_frame_slot(key)
+            stats = register_viewer(key, remote, size)
+            seq = 0
+            try:
+                while True:
+                    frame, new_seq, published_at = slot.wait(seq, timeout=5.0)
+                    if new_seq != seq:
+                        frame = slot.rendition(size, new_seq, frame)
+                        yield b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n'
+                        # Генератор продолжается, когда кадр уже записан в сокет
+                        stats.delivered(seq, new_seq, published_at)
+                        seq = new_seq
+            finally:
+                unregister_viewer(stats)
         else:
             # Показываем последнее записанное видео как слайдшоу
-            folder = VIDEOS / machine_id if machine_id != 'default' else VIDEOS
-            videos = sorted(folder.glob('*.mp4'), reverse=True)
-            if videos:
-                video_path = videos[0]
+            video_path = latest_recording(machine_id, monitor)
+            if video_path:
                 cap = cv2.VideoCapture(str(video_path))
                 while True:
                     ret, frame = cap.read()
@@ -179,15 +569,16 @@ def stream_mjpg():
                     # Конвертируем в JPEG
                     _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
                     frame_bytes = buffer.tobytes()
+                    if size in RENDITION_WIDTHS:
+                        frame_bytes = scale_jpeg(frame_bytes, RENDITION_WIDTHS[size])
                     yield b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n'
                     time.sleep(1.0 / 6)  # 6 FPS как в оригинале
                 
                 cap.release()
             else:
                 # Черный кадр если нет видео
-                black_frame = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x01\x00H\x00H\x00\x00\xff\xdb\x00C\x00\x08\x06\x06\x07\x06\x05\x08\x07\x07\x07\t\t\x08\n\x0c\x14\r\x0c\x0b\x0b\x0c\x19\x12\x13\x0f\x14\x1d\x1a\x1f\x1e\x1d\x1a\x1c\x1c $.\' ",#\x1c\x1c(7),01444\x1f\'9=82<.342\xff\xc0\x00\x11\x08\x00\x01\x00\x01\x01\x01\x11\x01\x02\x11\x01\xff\xc4\x00\x14\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x08\xff\xc4\x00\x14\x10\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xff\xda\x00\x08\x01\x01\x00\x00?\x00\xaa\xff\xd9'
                 while True:
-                    yield b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + black_frame + b'\r\n'
+                    yield b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + BLACK_JPEG + b'\r\n'
                     time.sleep(1)
     
     return Response(
@@ -195,28 +586,85 @@ def stream_mjpg():
         mimetype='multipart/x-mixed-replace; boundary=frame'
     )
 
+@app.route('/snapshot.jpg')
+def snapshot_jpg():
+    """Последний live-кадр одним JPEG (превью без постоянного соединения).
+    ?size=thumb|medium|full - как у /stream.mjpg"""
+    machine_id = request.args.get('machine_id', 'default')
+    monitor = request.args.get('monitor', type=int)
+    size = rendition_size(request.args.get('size'))
+    key = stream_key(machine_id, monitor)
+    frame = BLACK_JPEG
+    if has_live_frame(key):
+        slot = get_frame_slot(key)
+        frame, seq, _ = slot.latest()
+        frame = slot.rendition(size, seq, frame)
+    return Response(frame, mimetype='image/jpeg', headers={'Cache-Control': 'no-store'})
+
+@app.route('/api/viewers')
+def api_viewers():
+    """MJPEG-зрители: отправлено, пропущено кадров и задержка кадра"""
+    with live_viewers_guard:
+        viewers = [stats.as_dict() for stats in live_viewers.values()]
+    return jsonify(viewers)
+
 @app.route('/api/upload_frame', methods=['POST'])
 def upload_frame():
     """Получение кадра от клиента"""
     machine_id = request.args.get('machine_id') or request.headers.get('X-Machine-Id') or 'default'
+    monitor = request.args.get('monitor', type=int)
+    key = stream_key(machine_id, monitor)
     try:
         # Создаем папку для машины если её нет (чтобы она появилась в списке)
         if machine_id != 'default':
             machine_folder = VIDEOS / machine_id
             machine_folder.mkdir(exist_ok=True, parents=True)
         
-        lock = get_machine_lock(machine_id)
-        with lock:
-            machine_id_to_last_frame[machine_id] = request.data
+        get_frame_slot(key).publish(request.data)
         return 'ok', 200
     except Exception as e:
         print(f"[LIVE] upload_frame error for {machine_id}: {e}")
         return 'error', 500
 
+@app.route('/api/ingest', methods=['POST'])
+def ingest_frames():
+    """Постоянный канал кадров от клиента: одно длинное (chunked) POST-тело
+    из кадров [4 байта длины big-endian][JPEG]. Заголовки и маршрутизация
+    разбираются один раз на соединение, а не на каждый кадр"""
+    machine_id = request.args.get('machine_id') or request.headers.get('X-Machine-Id') or 'default'
+    monitor = request.args.get('monitor', type=int)
+    key = stream_key(machine_id, monitor)
+    if machine_id != 'default':
+        (VIDEOS / machine_id).mkdir(exist_ok=True, parents=True)
+    
+    slot = get_frame_slot(key)
+    stream = request.stream
+    frames = 0
+    print(f"[LIVE] ingest channel opened: {key}")
+    try:
+        while True:
+            header = read_exact(stream, 4)
+            if not header:
+                break
+            size, = struct.unpack('>I', header)
+            if size > MAX_INGEST_FRAME:
+                print(f"[LIVE] ingest frame too large from {key}: {size} bytes")
+                return 'frame too large', 413
+            frame = read_exact(stream, size)
+            if not frame:
+                break
+            slot.publish(frame)
+            frames += 1
+    except Exception as e:
+        print(f"[LIVE] ingest error for {key}: {e}")
+    print(f"[LIVE] ingest channel closed: {key} ({frames} frames)")
+    return 'ok', 200
+
 @app.route('/list/<machine_id>')
 def list_videos(machine_id: str):
-    folder = VIDEOS / machine_id if machine_id != 'default' else VIDEOS
-    videos = sorted(folder.glob('*.mp4'), reverse=True)
+    refresh_recordings_index()
+    videos = query_recordings("SELECT filename, size FROM recordings WHERE machine_id = ? "
+                              "ORDER BY filename DESC LIMIT 100", (machine_id,))
     html = """
     <!DOCTYPE html><html><head><meta charset="UTF-8"><title>Записи</title>
     <style>body{font-family:Arial;background:#f5f5f5;padding:30px;max-width:1400px;margin:0 auto}
@@ -224,12 +672,12 @@ def list_videos(machine_id: str):
     <h2>📼 Записи: %s</h2>
     <a href="/">← Назад</a>
     """ % machine_id
-    for v in videos[:100]:
-        mb = v.stat().st_size / (1024*1024)
+    for name, size in videos:
+        mb = size / (1024*1024)
         html += f"""
         <div class="video">
-            <div><strong>{v.name}</strong> — {mb:.2f} MB</div>
-            <a href="/play/{machine_id}/{v.name}">▶️ Смотреть</a>
+            <div><strong>{name}</strong> — {mb:.2f} MB</div>
+            <a href="/play/{machine_id}/{name}">▶️ Смотреть</a>
         </div>
         """
     html += "</body></html>"
@@ -246,6 +694,8 @@ def play_video_machine(machine_id, name):
     # Получаем информацию о видео
     mb = video_path.stat().st_size / (1024*1024)
     mtime = time.ctime(video_path.stat().st_mtime)
+    # Конвертация в H.264 начинается сразу, пока браузер грузит страницу
+    transcode = request_transcode(video_path)
     
     html = f"""
     <!DOCTYPE html>
@@ -276,7 +726,7 @@ def play_video_machine(machine_id, name):
         <div class="container">
             <a href="/list/{machine_id}">← Назад к списку</a>
             <h2>📹 {name}</h2>
-            <div class="info">💾 Размер: {mb:.2f} MB | 📅 {mtime}</div>
+            <div class="info">💾 Размер: {mb:.2f} MB | 📅 {mtime} <span id="transcode"></span></div>
             <video controls autoplay preload="metadata" playsinline>
                 <source src="/video/{machine_id}/{name}" type="video/mp4">
                 Ваш браузер не поддерживает воспроизведение видео.
@@ -290,8 +740,36 @@ def play_video_machine(machine_id, name):
             </div>
             <script>
                 const video = document.querySelector('video');
+                const transcodeInfo = document.getElementById('transcode');
+                let transcode = '{transcode}';
+                
+                // Пока сервер перекодирует файл, играет оригинал; когда H.264
+                // готов - переключаемся на него с той же позиции
+                function pollTranscode() {{
+                    fetch('/api/transcode/{machine_id}/{name}').then(r => r.json()).then(data => {{
+                        if (data.status === 'ready') {{
+                            const position = video.currentTime;
+                            video.src = '/video/{machine_id}/{name}?h264=1';
+                            video.addEventListener('loadedmetadata', () => {{ video.currentTime = position; }}, {{ once: true }});
+                            video.play();
+                            transcodeInfo.textContent = '';
+                        }} else if (data.status === 'queued' || data.status === 'processing') {{
+                            transcodeInfo.textContent = '| ⏳ Конвертация в H.264...';
+                            setTimeout(pollTranscode, 2000);
+                        }} else {{
+                            transcodeInfo.textContent = '';
+                        }}
+                    }});
+                }}
+                if (transcode === 'queued' || transcode === 'processing') {{
+                    transcodeInfo.textContent = '| ⏳ Конвертация в H.264...';
+                    pollTranscode();
+                }}
+                
                 video.addEventListener('error', function(e) {{
                     console.error('Video error:', video.error);
+                    // Оригинал не играет, но скоро будет H.264
+                    if (transcodeInfo.textContent) return;
                     alert('Ошибка воспроизведения: ' + (video.error ? video.error.message : 'Неизвестная ошибка'));
                 }});
                 video.addEventListener('loadeddata', function() {{
@@ -303,20 +781,244 @@ def play_video_machine(machine_id, name):
     """
     return html
 
+# Перекодирование в H.264 для браузера - в фоне: не больше TRANSCODE_WORKERS
+# процессов ffmpeg одновременно и одна задача на файл, сколько бы зрителей
+# его ни открыли. Пока задача идет, зрителю отдается оригинал.
+#
+# Задачи двух классов в одной очереди с приоритетом: файл, который открыл
+# зритель, - первым; новые сегменты (перекодирование при поступлении) - от
+# свежих к старым. Фоновые задачи ограничены бюджетом CPU: не больше
+# INGEST_TRANSCODE_WORKERS одновременно, с пониженным приоритетом процесса
+# и INGEST_TRANSCODE_THREADS потоками кодека
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', '2'))
+TRANSCODE_TIMEOUT = 300
+TRANSCODE_RETRY_AFTER = 600  # После ошибки не перезапускаем 10 минут
+TRANSCODE_VIEWER, TRANSCODE_INGEST = 0, 1
+INGEST_TRANSCODE = os.getenv('TRANSCODE_ON_INGEST', 'true').lower() == 'true'
+INGEST_TRANSCODE_WORKERS = int(os.getenv('INGEST_TRANSCODE_WORKERS', '1'))
+INGEST_TRANSCODE_THREADS = int(os.getenv('INGEST_TRANSCODE_THREADS', '1'))
+INGEST_TRANSCODE_NICE = 10
+INGEST_MAX_AGE_HOURS = float(os.getenv('INGEST_MAX_AGE_HOURS', '24'))
+INGEST_SCAN_INTERVAL = 10
+INGEST_SETTLE = 15  # Файл не менялся столько секунд - сегмент дописан
+transcode_queue = []  # heap: (класс, ключ очереди, порядок, путь к видео)
+transcode_order = itertools.count()
+transcode_jobs = {}  # путь кэша -> 'queued' / 'processing'
+transcode_failed = {}
+transcode_condition = threading.Condition()
+ingest_running = 0
+
+def h264_cache_path(video_path: Path) -> Path:
+    return video_path.parent / "_h264_cache" / video_path.name
+
+def transcode_status(video_path: Path) -> str:
+    """ready, queued, processing, failed или none (не запрашивалось)"""
+    cached_path = h264_cache_path(video_path)
+    if cached_path.exists() and cached_path.stat().st_size > 0:
+        return 'ready'
+    with transcode_condition:
+        state = transcode_jobs.get(cached_path)
+        if state is not None:
+            return state
+        failed_at = transcode_failed.get(cached_path)
+        if failed_at is not None and time.monotonic() - failed_at < TRANSCODE_RETRY_AFTER:
+            return 'failed'
+    return 'none'
+
+def request_transcode(video_path: Path, job_class: int = TRANSCODE_VIEWER, key: float = 0.0) -> str:
+    """Поставить файл в очередь перекодирования, если его там еще нет.
+    Зритель поднимает уже стоящую фоновую задачу в начало очереди"""
+    status = transcode_status(video_path)
+    if status not in ('none', 'queued'):
+        return status
+    cached_path = h264_cache_path(video_path)
+    with transcode_condition:
+        state = transcode_jobs.get(cached_path)
+        if state == 'processing' or (state == 'queued' and job_class == TRANSCODE_INGEST):
+            return state
+        # Старая запись в очереди останется, но воркер ее пропустит
+        transcode_jobs[cached_path] = 'queued'
+        heapq.heappush(transcode_queue, (job_class, key, next(transcode_order), video_path))
+        transcode_condition.notify()
+    return 'queued'
+
+def next_transcode_job():
+    """Следующая задача по приоритету; фоновая - только в пределах бюджета"""
+    global ingest_running
+    with transcode_condition:
+        while True:
+            while transcode_queue:
+                job_class, _, _, video_path = transcode_queue[0]
+                if transcode_jobs.get(h264_cache_path(video_path)) != 'queued':
+                    heapq.heappop(transcode_queue)  # Уже выполнена или выполняется
+                    continue
+                if job_class == TRANSCODE_INGEST and ingest_running >= INGEST_TRANSCODE_WORKERS:
+                    break
+                heapq.heappop(transcode_queue)
+                transcode_jobs[h264_cache_path(video_path)] = 'processing'
+                if job_class == TRANSCODE_INGEST:
+                    ingest_running += 1
+                return job_class, video_path
+            transcode_condition.wait()
+
+def transcode_worker():
+    global ingest_running
+    while True:
+        job_class, video_path = next_transcode_job()
+        cached_path = h264_cache_path(video_path)
+        try:
+            run_transcode(video_path, cached_path, background=job_class == TRANSCODE_INGEST)
+        finally:
+            with transcode_condition:
+                transcode_jobs.pop(cached_path, None)
+                if job_class == TRANSCODE_INGEST:
+                    ingest_running -= 1
+                transcode_condition.notify_all()
+
+for _ in range(TRANSCODE_WORKERS):
+    threading.Thread(target=transcode_worker, daemon=True, name='transcode').start()
+
+def run_transcode(video_path: Path, cached_path: Path, background: bool = False):
+    """Перекодирует во временный файл и атомарно переименовывает,
+    так что зрители никогда не видят недописанный кэш"""
+    tmp_path = cached_path.with_name(f".{cached_path.stem}.part.mp4")
+    try:
+        if cached_path.exists() and cached_path.stat().st_size > 0:
+            return
+        cached_path.parent.mkdir(exist_ok=True)
+        print(f"[CONVERT] Начинаю конвертацию {video_path.name}{' (фон)' if background else ''}...")
+        transcode_to_h264(video_path, tmp_path, background)
+        if not tmp_path.exists() or tmp_path.stat().st_size == 0:
+            raise RuntimeError("файл не создан")
+        tmp_path.replace(cached_path)
+        print(f"[CONVERT] Конвертация завершена: {video_path.name} ({cached_path.stat().st_size/1024/1024:.2f} MB)")
+    except subprocess.TimeoutExpired:
+        print(f"[CONVERT] Таймаут при конвертации {video_path.name}")
+        mark_transcode_failed(cached_path)
+    except subprocess.CalledProcessError as e:
+        print(f"[CONVERT] Ошибка конвертации {video_path.name}: {e.stderr.decode()[:200]}")
+        mark_transcode_failed(cached_path)
+    except Exception as e:
+        print(f"[CONVERT] Ошибка конвертации {video_path.name}: {e}")
+        mark_transcode_failed(cached_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+def mark_transcode_failed(cached_path: Path):
+    with transcode_condition:
+        transcode_failed[cached_path] = time.monotonic()
+
+def queue_new_segments(done: set) -> set:
+    """Новые дописанные сегменты за INGEST_MAX_AGE_HOURS - в очередь
+    перекодирования, свежие первыми. done - уже поставленные ранее"""
+    refresh_recordings_index()
+    now = time.time()
+    seen = set()
+    for machine_id, filename, start_time in query_recordings(
+            "SELECT machine_id, filename, start_time FROM recordings WHERE start_time >= ? "
+            "ORDER BY start_time DESC", (now - INGEST_MAX_AGE_HOURS * 3600,)):
+        video_path = machine_folder(machine_id) / filename
+        if video_path in done:
+            seen.add(video_path)
+            continue
+        try:
+            if now - video_path.stat().st_mtime < INGEST_SETTLE:
+                continue  # Сегмент еще записывается
+        except OSError:
+            continue
+        if request_transcode(video_path, TRANSCODE_INGEST, -start_time) in ('queued', 'processing', 'ready'):
+            seen.add(video_path)
+    return seen
+
+def watch_ingest():
+    """Фоновый поток: перекодирование сегментов при поступлении, чтобы
+    первое воспроизведение сразу попадало в кэш"""
+    done = set()
+    while True:
+        try:
+            done = queue_new_segments(done)
+        except Exception as e:
+            print(f"[CONVERT] Ошибка поиска новых сегментов: {e}")
+        time.sleep(INGEST_SCAN_INTERVAL)
+
+def transcode_to_h264(video_path: Path, out_path: Path, background: bool = False):
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg:
+        # Быстрая перекодировка с moov в начале файла (faststart)
+        cmd = [
+            ffmpeg,
+            '-y',
+            '-i', str(video_path),
+            '-c:v', 'libx264',
+            '-preset', 'veryfast',
+            '-pix_fmt', 'yuv420p',
+            '-movflags', '+faststart',
+            '-an',  # без звука
+            str(out_path)
+        ]
+        if background:
+            # Бюджет CPU фоновой задачи: потоки кодека и приоритет процесса.
+            # Приоритет - через nice, а не preexec_fn: fork в многопоточном
+            # сервере с кодом Python до exec может зависнуть
+            cmd[1:1] = ['-threads', str(INGEST_TRANSCODE_THREADS)]
+            cmd[-1:-1] = ['-threads', str(INGEST_TRANSCODE_THREADS)]
+            nice = shutil.which('nice')
+            if nice:
+                cmd[:0] = [nice, '-n', str(INGEST_TRANSCODE_NICE)]
+        subprocess.run(
+            cmd,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=TRANSCODE_TIMEOUT
+        )
+        return
+    
+    # ffmpeg не найден - используем OpenCV для конвертации (медленно, но работает)
+    cap = cv2.VideoCapture(str(video_path))
+    if not cap.isOpened():
+        raise Exception("Cannot open video")
+    
+    # Получаем параметры видео
+    fps = int(cap.get(cv2.CAP_PROP_FPS)) or 6
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    
+    # Пробуем использовать H.264 кодек
+    fourcc = cv2.VideoWriter_fourcc(*'avc1')
+    if fourcc == -1:
+        fourcc = cv2.VideoWriter_fourcc(*'H264')
+    if fourcc == -1:
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # Fallback
+    
+    out = cv2.VideoWriter(str(out_path), fourcc, fps, (width, height))
+    
+    frame_count = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        out.write(frame)
+        frame_count += 1
+        
+        # Ограничиваем размер во избежание зависания
+        if frame_count > 10000:
+            break
+    
+    cap.release()
+    out.release()
+
 @app.route('/video/<machine_id>/<name>')
 def video(machine_id, name):
-    """Отдача видео. Если браузер не может воспроизвести, пробуем транскодировать в H.264 (ffmpeg)."""
+    """Отдача видео. Перекодированное в H.264 - из кэша; если его еще нет,
+    ставим перекодирование в очередь и отдаем оригинал (статус - в X-Transcode-Status)"""
     folder = VIDEOS / machine_id if machine_id != 'default' else VIDEOS
     video_path = folder / name
     if not video_path.exists():
         return "Video not found", 404
 
-    # Кэш для перекодированных файлов
-    cache_dir = folder / "_h264_cache"
-    cache_dir.mkdir(exist_ok=True)
-    cached_path = cache_dir / name
-
     # Если уже перекодировано ранее — отдаем кэш
+    cached_path = h264_cache_path(video_path)
     if cached_path.exists() and cached_path.stat().st_size > 0:
         print(f"[VIDEO] Отдаю конвертированное видео: {name} ({cached_path.stat().st_size/1024/1024:.2f} MB)")
         return send_file(
@@ -326,109 +1028,34 @@ def video(machine_id, name):
             conditional=True
         )
 
-    # Если есть ffmpeg — попробуем перекодировать в совместимый формат
-    ffmpeg = shutil.which('ffmpeg')
-    if ffmpeg:
-        try:
-            print(f"[CONVERT] Начинаю конвертацию {name}...")
-            # Быстрая перекодировка с moov в начале файла (faststart)
-            cmd = [
-                ffmpeg,
-                '-y',
-                '-i', str(video_path),
-                '-c:v', 'libx264',
-                '-preset', 'veryfast',
-                '-pix_fmt', 'yuv420p',
-                '-movflags', '+faststart',
-                '-an',  # без звука
-                str(cached_path)
-            ]
-            result = subprocess.run(
-                cmd, 
-                check=True, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.PIPE, 
-                timeout=300
-            )
-            print(f"[CONVERT] Конвертация завершена: {cached_path.stat().st_size/1024/1024:.2f} MB")
-            
-            if cached_path.exists() and cached_path.stat().st_size > 0:
-                return send_file(
-                    str(cached_path),
-                    mimetype='video/mp4',
-                    as_attachment=False,
-                    conditional=True
-                )
-            else:
-                print(f"[CONVERT] Ошибка: файл не создан")
-        except subprocess.TimeoutExpired:
-            print(f"[CONVERT] Таймаут при конвертации {name}")
-        except subprocess.CalledProcessError as e:
-            print(f"[CONVERT] Ошибка конвертации {name}: {e.stderr.decode()[:200]}")
-        except Exception as e:
-            print(f"[CONVERT] Неожиданная ошибка: {e}")
-    else:
-        # ffmpeg не найден - используем OpenCV для конвертации (медленно, но работает)
-        try:
-            cap = cv2.VideoCapture(str(video_path))
-            if not cap.isOpened():
-                raise Exception("Cannot open video")
-            
-            # Получаем параметры видео
-            fps = int(cap.get(cv2.CAP_PROP_FPS)) or 6
-            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            
-            # Пробуем использовать H.264 кодек
-            fourcc = cv2.VideoWriter_fourcc(*'avc1')
-            if fourcc == -1:
-                fourcc = cv2.VideoWriter_fourcc(*'H264')
-            if fourcc == -1:
-                fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # Fallback
-            
-            out = cv2.VideoWriter(str(cached_path), fourcc, fps, (width, height))
-            
-            frame_count = 0
-            while True:
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                out.write(frame)
-                frame_count += 1
-                
-                # Ограничиваем размер во избежание зависания
-                if frame_count > 10000:
-                    break
-            
-            cap.release()
-            out.release()
-            
-            if cached_path.exists() and cached_path.stat().st_size > 0:
-                return send_file(
-                    str(cached_path),
-                    mimetype='video/mp4',
-                    as_attachment=False,
-                    conditional=True
-                )
-        except Exception as e:
-            print(f"OpenCV conversion failed: {e}")
-
-    # Отдаем оригинал только если конвертация не удалась (может не воспроизвестись в некоторых браузерах)
-    print(f"[VIDEO] Отдаю оригинальное видео (не конвертировано): {name}")
-    return send_file(
+    # Оригинал может не воспроизвестись в некоторых браузерах - страница
+    # просмотра переключится на H.264, когда конвертация закончится
+    status = request_transcode(video_path)
+    print(f"[VIDEO] Отдаю оригинальное видео (конвертация: {status}): {name}")
+    response = send_file(
         str(video_path),
         mimetype='video/mp4',
         as_attachment=False,
         conditional=True
     )
+    response.headers['X-Transcode-Status'] = status
+    return response
+
+@app.route('/api/transcode/<machine_id>/<name>')
+def api_transcode(machine_id, name):
+    """Статус перекодирования файла в H.264"""
+    folder = VIDEOS / machine_id if machine_id != 'default' else VIDEOS
+    video_path = folder / name
+    if not video_path.exists():
+        return jsonify({'error': 'Video not found'}), 404
+    return jsonify({'status': transcode_status(video_path)})
 
 @app.route('/test/<machine_id>/<name>')
 def test_video(machine_id, name):
     """Тестовая страница для проверки видео"""
     folder = VIDEOS / machine_id if machine_id != 'default' else VIDEOS
     video_path = folder / name
-    cache_dir = folder / "_h264_cache"
-    cached_path = cache_dir / name
+    cached_path = h264_cache_path(video_path)
     
     has_original = video_path.exists()
     has_converted = cached_path.exists() and cached_path.stat().st_size > 0
@@ -471,12 +1098,313 @@ def test_video(machine_id, name):
     """
     return html
 
+# ---------------------------------------------------------------------------
+# Асинхронный режим (ASYNC_LIVE=true): один asyncio-процесс на том же порту.
+# /stream.mjpg, /api/upload_frame и /api/ingest обслуживаются корутинами -
+# зритель не держит поток. Остальные маршруты (страницы, /video, /live)
+# выполняются Flask-приложением через WSGI в пуле потоков.
+# ---------------------------------------------------------------------------
+
+ASYNC_WSGI_THREADS = int(os.getenv('ASYNC_WSGI_THREADS', '16'))
+async_executor = None
+
+class ReplayFeed:
+    """Повтор последней записи: один декодер на файл для всех зрителей,
+    работает только пока есть зрители. Без зрителей и с остановленным
+    декодером feed убирается из replay_feeds вместе с последним кадром.
+    Все вызовы - из цикла событий, блокировки не нужны"""
+    
+    def __init__(self, path: Path):
+        self.path = path
+        self.slot = FrameSlot()
+        self.viewers = 0
+        self.task = None
+    
+    def attach(self):
+        self.viewers += 1
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+    
+    def detach(self):
+        self.viewers -= 1
+        if self.task is None or self.task.done():
+            self._forget()
+    
+    def _forget(self):
+        if self.viewers == 0 and replay_feeds.get(str(self.path)) is self:
+            del replay_feeds[str(self.path)]
+    
+    def _next_jpeg(self, cap):
+        ret, frame = cap.read()
+        if not ret:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)  # Перематываем на начало
+            ret, frame = cap.read()
+            if not ret:
+                return None
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        return buffer.tobytes()
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        cap = await loop.run_in_executor(async_executor, cv2.VideoCapture, str(self.path))
+        try:
+            while self.viewers > 0:
+                frame = await loop.run_in_executor(async_executor, self._next_jpeg, cap)
+                if frame:
+                    self.slot.publish(frame)
+                await asyncio.sleep(1.0 / 6)  # 6 FPS как в оригинале
+        finally:
+            cap.release()
+            self._forget()
+
+replay_feeds = {}
+
+def get_replay_feed(video_path: Path) -> ReplayFeed:
+    feed = replay_feeds.get(str(video_path))
+    if feed is None:
+        feed = replay_feeds[str(video_path)] = ReplayFeed(video_path)
+    return feed
+
+def http_response(status: str, body: bytes = b'', content_type='text/plain; charset=utf-8', keep_alive=True) -> bytes:
+    head = (f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode('latin-1') + body
+
+async def read_request_head(reader):
+    """Строка запроса и заголовки; None - клиент закрыл соединение"""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, target, version = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+async def iter_request_body(reader, headers):
+    """Тело запроса кусками: chunked или по Content-Length"""
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            yield await reader.readexactly(size)
+            await reader.readline()
+    else:
+        remaining = int(headers.get('content-length', '0'))
+        while remaining > 0:
+            block = await reader.read(min(remaining, 256 * 1024))
+            if not block:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(block)
+            yield block
+
+async def read_request_body(reader, headers) -> bytes:
+    body = bytearray()
+    async for block in iter_request_body(reader, headers):
+        body += block
+    return bytes(body)
+
+def live_stream_key(args, headers):
+    machine_id = args.get('machine_id') or headers.get('x-machine-id') or 'default'
+    monitor = args.get('monitor')
+    monitor = int(monitor) if monitor and monitor.isdigit() else None
+    if machine_id != 'default':
+        (VIDEOS / machine_id).mkdir(exist_ok=True, parents=True)
+    return stream_key(machine_id, monitor)
+
+async def async_upload_frame(reader, writer, args, headers):
+    key = live_stream_key(args, headers)
+    get_frame_slot(key).publish(await read_request_body(reader, headers))
+    writer.write(http_response('200 OK', b'ok'))
+
+async def async_ingest(reader, writer, args, headers):
+    """Постоянный канал кадров [4 байта длины][JPEG], как /api/ingest во Flask"""
+    key = live_stream_key(args, headers)
+    slot = get_frame_slot(key)
+    print(f"[LIVE] ingest channel opened: {key}")
+    buffer = bytearray()
+    frames = 0
+    async for block in iter_request_body(reader, headers):
+        buffer += block
+        while len(buffer) >= 4:
+            size, = struct.unpack_from('>I', buffer)
+            if size > MAX_INGEST_FRAME:
+                print(f"[LIVE] ingest frame too large from {key}: {size} bytes")
+                writer.write(http_response('413 Request Entity Too Large', b'frame too large', keep_alive=False))
+                return False
+            if len(buffer) < 4 + size:
+                break
+            slot.publish(bytes(buffer[4:4 + size]))
+            del buffer[:4 + size]
+            frames += 1
+    print(f"[LIVE] ingest channel closed: {key} ({frames} frames)")
+    writer.write(http_response('200 OK', b'ok'))
+    return True
+
+async def async_stream_mjpg(writer, args):
+    """MJPEG-зритель как корутина: ждет новый кадр в FrameSlot (live или
+    повтор записи) и отправляет каждый кадр один раз"""
+    machine_id = args.get('machine_id', 'default')
+    monitor = args.get('monitor')
+    monitor = int(monitor) if monitor and monitor.isdigit() else None
+    size = rendition_size(args.get('size'))
+    key = stream_key(machine_id, monitor)
+    loop = asyncio.get_running_loop()
+    
+    # drain() ждет, пока кадр целиком уйдет в сокет, а буфер сокета мал
+    limit_send_buffer(writer.get_extra_info('socket'))
+    writer.transport.set_write_buffer_limits(high=0)
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=frame\r\n"
+                 b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+    
+    feed = None
+    if has_live_frame(key):
+        slot = get_frame_slot(key)
+    else:
+        # Индекс может досканировать папку - не в цикле событий
+        video_path = await loop.run_in_executor(async_executor, latest_recording, machine_id, monitor)
+        if video_path:
+            feed = get_replay_feed(video_path)
+            feed.attach()
+            slot = feed.slot
+        else:
+            # Черный кадр, пока машина не начала трансляцию
+            writer.write(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + BLACK_JPEG + b'\r\n')
+            slot = get_frame_slot(key)
+    
+    stats = register_viewer(key, (writer.get_extra_info('peername') or ('',))[0], size)
+    seq = 0
+    try:
+        while True:
+            frame, new_seq, published_at = await slot.wait_async(seq, 5.0)
+            if new_seq != seq:
+                if size in RENDITION_WIDTHS:
+                    # Сжатие - в пуле потоков, не в цикле событий
+                    frame = await loop.run_in_executor(async_executor, slot.rendition, size, new_seq, frame)
+                writer.write(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+            # drain и на таймауте: так замечаем отключившегося зрителя
+            await writer.drain()
+            if new_seq != seq:
+                stats.delivered(seq, new_seq, published_at)
+                seq = new_seq
+    finally:
+        unregister_viewer(stats)
+        if feed is not None:
+            feed.detach()
+
+async def call_wsgi_app(reader, writer, method, url, version, headers):
+    """Остальные маршруты - Flask-приложение в пуле потоков. Соединение
+    после ответа закрывается, так как длина тела заранее не всегда известна"""
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        writer.write(http_response('411 Length Required', keep_alive=False))
+        return
+    body = await read_request_body(reader, headers)
+    peer = writer.get_extra_info('peername') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote(url.path, encoding='latin-1'),
+        'QUERY_STRING': url.query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': str(writer.get_extra_info('sockname')[1]),
+        'SERVER_PROTOCOL': version,
+        'REMOTE_ADDR': peer[0],
+        'CONTENT_TYPE': headers.get('content-type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers.items():
+        if name not in ('content-type', 'content-length'):
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+    
+    response = {}
+    def start_response(status, response_headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = response_headers
+    
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(async_executor, app, environ, start_response)
+    try:
+        chunks = iter(result)
+        chunk = await loop.run_in_executor(async_executor, next, chunks, None)
+        head = f"HTTP/1.1 {response['status']}\r\n"
+        head += ''.join(f"{name}: {value}\r\n" for name, value in response['headers']
+                        if name.lower() != 'connection')
+        writer.write((head + "Connection: close\r\n\r\n").encode('latin-1'))
+        while chunk is not None:
+            if chunk and method != 'HEAD':
+                writer.write(chunk)
+                await writer.drain()
+            chunk = await loop.run_in_executor(async_executor, next, chunks, None)
+    finally:
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(async_executor, result.close)
+
+async def handle_async_connection(reader, writer):
+    try:
+        while True:
+            # Неактивное keep-alive соединение закрываем через минуту
+            request_head = await asyncio.wait_for(read_request_head(reader), 60)
+            if request_head is None:
+                break
+            method, target, version, headers = request_head
+            url = urlsplit(target)
+            args = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            
+            if url.path == '/stream.mjpg' and method == 'GET':
+                await async_stream_mjpg(writer, args)
+                break
+            elif url.path == '/api/upload_frame' and method == 'POST':
+                await async_upload_frame(reader, writer, args, headers)
+            elif url.path == '/api/ingest' and method == 'POST':
+                if not await async_ingest(reader, writer, args, headers):
+                    break
+            else:
+                await call_wsgi_app(reader, writer, method, url, version, headers)
+                break
+            await writer.drain()
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+        pass  # Клиент отключился или прислал некорректный запрос
+    except Exception as e:
+        print(f"[ASYNC] request error: {e}")
+    finally:
+        writer.close()
+
+async def serve_async(host: str, port: int):
+    global async_executor
+    async_executor = ThreadPoolExecutor(max_workers=ASYNC_WSGI_THREADS, thread_name_prefix='wsgi')
+    server = await asyncio.start_server(handle_async_connection, host, port, limit=256 * 1024)
+    async with server:
+        await server.serve_forever()
+
+
 if __name__ == '__main__':
     print(f"\n{'='*60}")
     print(f"  📹 СЕРВЕР: http://localhost:6789")
     print(f"  🔴 LIVE: http://localhost:6789/live")
     print(f"{'='*60}\n")
-    app.run(host='0.0.0.0', port=6789)
+    if INGEST_TRANSCODE:
+        threading.Thread(target=watch_ingest, daemon=True).start()
+    if ASYNC_LIVE:
+        print("  ⚡ Асинхронный режим: live-зрители обслуживаются корутинами\n")
+        asyncio.run(serve_async('0.0.0.0', 6789))
+    else:
+        app.run(host='0.0.0.0', port=6789)
 
 
 
@@ -6,17 +6,29 @@ Monitors user activity and uploads to server
 import cv2
 import numpy as np
 from PIL import ImageGrab
+try:
+    from mss import mss  # Faster capture straight into a buffer, if installed
+except ImportError:
+    mss = None
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.filepost import encode_multipart_formdata
+from urllib3.util.retry import Retry
 import os
+import sys
+import ctypes
 import json
 import socket
 import datetime
+import hashlib
 import threading
 from pathlib import Path
 import logging
 import shutil
+import struct
 import subprocess
+import tempfile
 
 # Setup logging
 logging.basicConfig(
@@ -24,15 +36,677 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# urllib3 logs a warning for every connect retry; failures are reported by the caller
+logging.getLogger('urllib3.connectionpool').setLevel(logging.ERROR)
+
+# Chunk size for resumable uploads
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with a keep-alive pool and connection reuse statistics.
+
+    urllib3 checks whether a pooled connection was dropped by the server and
+    reconnects; Retry(connect=...) retries when the reconnect itself fails.
+    """
+
+    def __init__(self, pool_maxsize=2):
+        self.pools = []
+        super().__init__(pool_connections=1, pool_maxsize=pool_maxsize,
+                         max_retries=Retry(total=2, connect=2, read=0, backoff_factor=0.2))
+
+    def _track(self, pool):
+        if pool not in self.pools:
+            self.pools.append(pool)
+        return pool
+
+    def get_connection(self, *args, **kwargs):
+        return self._track(super().get_connection(*args, **kwargs))
+
+    def get_connection_with_tls_context(self, *args, **kwargs):
+        # requests >= 2.32 calls this instead of get_connection
+        return self._track(super().get_connection_with_tls_context(*args, **kwargs))
+
+    def stats(self):
+        """How many requests were sent and how many TCP connections that took"""
+        requests_sent = sum(pool.num_requests for pool in self.pools)
+        connections = sum(pool.num_connections for pool in self.pools)
+        return {
+            'requests': requests_sent,
+            'connections': connections,
+            'reused': max(0, requests_sent - connections),
+        }
+
+
+def create_http_session(pool_maxsize=2):
+    """requests session with persistent connections, kept for the recorder lifetime"""
+    session = requests.Session()
+    adapter = PooledHTTPAdapter(pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session, adapter
+
+
+class BandwidthManager:
+    """Token bucket for the upstream link, shared by two priority classes.
+
+    'live' traffic (fragments of the segment being recorded) takes tokens
+    first; 'bulk' traffic (spooled segment uploads) gets what is left. Bulk
+    also earns a reserved credit of bulk_share of the rate, so a saturated
+    live stream cannot stop uploads entirely. Live blocks may take the
+    bucket negative (sent right away, the debt is paid by later senders);
+    bulk blocks wait until the tokens are actually there.
+
+    Live frames of the screen stream are sent by client_live.py, a separate
+    process with its own bucket. It publishes its current live byte rate in
+    live_rate_file; this bucket refills that much slower (but never below
+    bulk_share of the rate), so segment uploads leave room for the stream.
+    Inside this process FragmentUploader is the live sender.
+    """
+
+    LIVE = 'live'
+    BULK = 'bulk'
+
+    def __init__(self, rate=None, bulk_share=0.2, live_rate_file=None):
+        self.rate = rate  # bytes per second, None = unlimited
+        self.bulk_share = bulk_share
+        self.live_rate_file = live_rate_file
+        self.external_live = 0.0  # bytes per second reported by client_live.py
+        self.external_checked = 0.0
+        self.burst = max(rate // 4, 64 * 1024) if rate else 0
+        self.tokens = self.burst
+        self.bulk_credit = 0.0
+        self.last_refill = time.monotonic()
+        self.live_waiting = 0
+        self.condition = threading.Condition()
+        self.bytes_sent = {self.LIVE: 0, self.BULK: 0}
+        self.throttled_seconds = {self.LIVE: 0.0, self.BULK: 0.0}
+
+    def _external_live_rate(self):
+        """Live rate published by client_live.py, re-read at most once a second"""
+        now = time.monotonic()
+        if self.live_rate_file and now - self.external_checked >= 1:
+            self.external_checked = now
+            try:
+                report = json.loads(Path(self.live_rate_file).read_text())
+                fresh = time.time() - report['time'] < LIVE_RATE_STALE
+                self.external_live = float(report['bytes_per_second']) if fresh else 0.0
+            except (OSError, ValueError, KeyError, TypeError):
+                self.external_live = 0.0
+        return self.external_live
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        # The live stream of the other process uses part of the link
+        rate = max(self.rate * self.bulk_share, self.rate - self._external_live_rate())
+        self.tokens = min(self.burst, self.tokens + elapsed * rate)
+        self.bulk_credit = min(self.burst, self.bulk_credit + elapsed * self.rate * self.bulk_share)
+
+    def acquire(self, nbytes, priority=BULK):
+        """Block until nbytes may be sent in the given priority class"""
+        start = time.monotonic()
+        with self.condition:
+            if self.rate:
+                if priority == self.LIVE:
+                    self.live_waiting += 1
+                try:
+                    while True:
+                        self._refill()
+                        if priority == self.LIVE:
+                            ready = self.tokens > 0
+                        elif self.live_waiting:
+                            # Reserved bulk share, even while live traffic waits
+                            ready = self.tokens > 0 and self.bulk_credit > 0
+                            if ready:
+                                self.bulk_credit -= nbytes
+                        else:
+                            # Otherwise bulk takes no debt, so it never delays live blocks
+                            ready = self.tokens >= min(nbytes, self.burst)
+                        if ready:
+                            break
+                        self.condition.wait(max(0.001, -self.tokens / self.rate) if self.tokens <= 0 else 0.01)
+                    self.tokens -= nbytes
+                finally:
+                    if priority == self.LIVE:
+                        self.live_waiting -= 1
+                        self.condition.notify_all()
+            self.bytes_sent[priority] += nbytes
+            self.throttled_seconds[priority] += time.monotonic() - start
+
+    def stats(self):
+        with self.condition:
+            usage = {
+                priority: {'bytes': self.bytes_sent[priority],
+                           'throttled_s': round(self.throttled_seconds[priority], 1)}
+                for priority in (self.LIVE, self.BULK)
+            }
+            usage['stream_bps'] = round(self.external_live)
+            return usage
+
+
+# A live rate report older than this means the stream process is idle or gone
+LIVE_RATE_STALE = 5
+# Shared with client_live.py, which writes the live rate report here
+DEFAULT_LIVE_RATE_FILE = Path(tempfile.gettempdir()) / 'screen_recorder_live_rate.json'
+
+
+def create_bandwidth_manager():
+    """BandwidthManager configured from UPLOAD_RATE_KBPS (kilobits/s), BULK_MIN_SHARE
+    and LIVE_RATE_FILE (live rate report of client_live.py)"""
+    rate_kbps = int(os.getenv('UPLOAD_RATE_KBPS', '0'))
+    return BandwidthManager(rate=rate_kbps * 1000 // 8 or None,
+                            bulk_share=float(os.getenv('BULK_MIN_SHARE', '0.2')),
+                            live_rate_file=os.getenv('LIVE_RATE_FILE') or DEFAULT_LIVE_RATE_FILE)
+
+
+class ThrottledBody:
+    """Request body that is handed to the socket only as the bandwidth manager allows"""
+
+    def __init__(self, data, bandwidth, priority):
+        self.data = memoryview(data)
+        self.position = 0
+        self.bandwidth = bandwidth
+        self.priority = priority
+
+    def __len__(self):
+        return len(self.data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.data)
+        block = self.data[self.position:self.position + min(size, 64 * 1024)]
+        self.position += len(block)
+        if block:
+            self.bandwidth.acquire(len(block), self.priority)
+        return block.tobytes()
+
+
+class FrameScheduler:
+    """Frame pacing against absolute deadlines on the monotonic clock.
+
+    Frame n is due at start + n / fps, so per-frame processing time does not
+    shift the schedule. When capture runs late, the slots whose deadlines
+    already passed are counted as dropped; callers can fill them by repeating
+    a frame so the frame count matches the container fps.
+    """
+
+    def __init__(self, fps, duration=None):
+        self.interval = 1.0 / fps
+        self.total_frames = int(fps * duration) if duration else None
+        self.start = time.monotonic()
+        self.next_frame = 0
+        self.dropped = 0
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def done(self):
+        if self.total_frames is not None:
+            return self.next_frame >= self.total_frames
+        return False
+
+    def wait(self):
+        """Wait for the next frame deadline. Returns the number of missed slots"""
+        now = time.monotonic()
+        deadline = self.start + self.next_frame * self.interval
+        missed = 0
+        if now < deadline:
+            time.sleep(deadline - now)
+        else:
+            missed = int((now - deadline) / self.interval)
+            if self.total_frames is not None:
+                missed = min(missed, max(0, self.total_frames - self.next_frame - 1))
+        self.next_frame += missed + 1
+        self.dropped += missed
+        return missed
+
+
+def file_sha256(path):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def segment_sha256(path):
+    """Content hash of a finished segment, cached in a <name>.sha256 sidecar.
+
+    Together with the machine id and segment name the server uses it to
+    recognise a retry after a lost response, so the segment is not stored twice.
+    """
+    sidecar = path.with_name(path.name + '.sha256')
+    try:
+        return sidecar.read_text().strip()
+    except FileNotFoundError:
+        pass
+    sha256 = file_sha256(path)
+    sidecar.write_text(sha256)
+    return sha256
+
+
+def remove_sidecars(path):
+    """Delete the upload state and hash files kept next to a segment"""
+    for sidecar in path.parent.glob(path.name + '.*'):
+        sidecar.unlink(missing_ok=True)
+
+
+class FramePool:
+    """Small pool of same-sized frame buffers.
+
+    A buffer is taken with acquire() and handed back with release() once the
+    frame has been written, so the next capture reuses it instead of
+    allocating a new full-resolution array.
+    """
+    def __init__(self, max_buffers=4):
+        self.max_buffers = max_buffers
+        self.free = {}
+        self.lock = threading.Lock()
+        self.allocated = 0
+
+    def acquire(self, shape):
+        with self.lock:
+            buffers = self.free.get(shape)
+            if buffers:
+                return buffers.pop()
+            self.allocated += 1
+        return np.empty(shape, dtype=np.uint8)
+
+    def release(self, frame):
+        with self.lock:
+            buffers = self.free.setdefault(frame.shape, [])
+            if len(buffers) < self.max_buffers:
+                buffers.append(frame)
+
+
+def grab_to_bgr(screenshot, pool):
+    """Convert a PIL screenshot (RGB, or RGBA on macOS) into a pooled BGR buffer."""
+    src = np.asarray(screenshot)
+    code = cv2.COLOR_RGBA2BGR if src.ndim == 3 and src.shape[2] == 4 else cv2.COLOR_RGB2BGR
+    frame = pool.acquire((src.shape[0], src.shape[1], 3))
+    result = cv2.cvtColor(src, code, dst=frame)
+    if result is not frame:
+        pool.release(frame)
+    return result
+
+
+class ScreenCapture:
+    """Screen capture straight into pooled BGR buffers.
+
+    With mss the BGRA screenshot buffer is wrapped with np.frombuffer (no copy)
+    and colour-converted into a pooled buffer. Without mss, PIL ImageGrab is
+    used and np.asarray leaves one intermediate copy.
+    """
+
+    def __init__(self, pool, monitor=0):
+        self.pool = pool
+        self.monitor = monitor  # index into mss.monitors, 0 = all screens combined
+        self.sct = None
+
+    def grab(self):
+        if mss is None:
+            return grab_to_bgr(ImageGrab.grab(all_screens=True), self.pool)
+        # Create mss in the capturing thread; instances should not be shared across threads
+        if self.sct is None:
+            self.sct = mss()
+        shot = self.sct.grab(self.sct.monitors[self.monitor])
+        src = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        frame = self.pool.acquire((src.shape[0], src.shape[1], 3))
+        return cv2.cvtColor(src, cv2.COLOR_BGRA2BGR, dst=frame)
+
+
+class FfmpegPipeWriter:
+    """Streams raw BGR frames into an ffmpeg libx264 process through its stdin.
+
+    Every frame is encoded once, straight to H.264 + faststart, so the file is
+    upload-ready as soon as release() returns. Exposes the same write/release/
+    isOpened interface as cv2.VideoWriter.
+
+    If the encoder dies while frames are written (libx264 missing, unsupported
+    pixel format, broken pipe), the rest of the segment goes to an mp4v
+    cv2.VideoWriter at the same path; failed is set in both cases.
+    """
+
+    def __init__(self, ffmpeg, path, fps, size, movflags='+faststart', extra_args=()):
+        self.path = path
+        self.fps = fps
+        self.size = size
+        self.failed = False
+        self.fallback = None
+        width, height = size
+        cmd = [
+            ffmpeg,
+            '-y',
+            '-loglevel', 'error',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-s', f'{width}x{height}',
+            '-r', str(fps),
+            '-i', '-',
+            '-c:v', 'libx264',
+            '-preset', 'veryfast',
+            # yuv420p needs even dimensions
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+            '-pix_fmt', 'yuv420p',
+            '-movflags', movflags,
+            *extra_args,
+            '-an',
+            str(path)
+        ]
+        self.process = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def isOpened(self):
+        if self.fallback is not None:
+            return self.fallback.isOpened()
+        return not self.failed and self.process.poll() is None
+
+    def _fall_back(self, reason):
+        """Switch the rest of the segment to cv2.VideoWriter"""
+        self.failed = True
+        self.process.kill()
+        try:
+            _, stderr = self.process.communicate()
+            detail = stderr.decode(errors='replace').strip()[:200]
+        except (OSError, ValueError):
+            detail = ''
+        logger.error(f"ffmpeg encoder stopped ({reason}) {detail}; continuing with OpenCV mp4v")
+        self.fallback = cv2.VideoWriter(
+            str(self.path), cv2.VideoWriter_fourcc(*'mp4v'), self.fps, self.size)
+
+    def write(self, frame):
+        if self.fallback is not None:
+            self.fallback.write(frame)
+            return
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            # cv2.VideoWriter silently drops frames of the wrong size too
+            return
+        try:
+            self.process.stdin.write(frame.data)
+        except (BrokenPipeError, OSError) as e:
+            self._fall_back(e)
+            self.fallback.write(frame)
+
+    def release(self):
+        if self.fallback is not None:
+            self.fallback.release()
+            return
+        # communicate() closes stdin, which lets ffmpeg finish the file
+        try:
+            _, stderr = self.process.communicate(timeout=120)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            _, stderr = self.process.communicate()
+        if self.process.returncode != 0:
+            self.failed = True
+            logger.error(f"ffmpeg exited with {self.process.returncode}: {stderr.decode(errors='replace')[:200]}")
+
+
+class FragmentUploader:
+    """Uploads a fragmented MP4 to /upload/append while it is still being recorded.
+
+    Only complete top-level boxes (ftyp/moov, then moof+mdat fragments) are
+    sent, so the server-side file is always a playable fMP4 prefix. On a 409
+    the server reports its real file size and the next push resumes there.
+    """
+
+    def __init__(self, recorder, path, interval):
+        self.recorder = recorder
+        self.path = path
+        self.interval = interval
+        self.offset = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="fragment-uploader", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.push(final=False)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def finish(self, attempts=3):
+        """Send the rest of the file once the encoder has closed it"""
+        self.stop()
+        for attempt in range(attempts):
+            if self.push(final=True):
+                return True
+            time.sleep(2)
+        return False
+
+    def complete_boxes_end(self, size):
+        """Offset right after the last complete top-level box below size"""
+        end = self.offset
+        with open(self.path, 'rb') as f:
+            while end + 8 <= size:
+                f.seek(end)
+                box_size, = struct.unpack('>I', f.read(4))
+                if box_size == 1:
+                    f.seek(end + 8)
+                    box_size, = struct.unpack('>Q', f.read(8))
+                if box_size < 8 or end + box_size > size:
+                    break
+                end += box_size
+        return end
+
+    def push(self, final):
+        try:
+            size = self.path.stat().st_size
+            end = size if final else self.complete_boxes_end(size)
+            if end <= self.offset and not final:
+                return True
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read(end - self.offset)
+            response = self.recorder.http.post(
+                f"http://{self.recorder.server_ip}:5000/upload/append",
+                params={
+                    'machine_id': self.recorder.machine_id,
+                    'filename': self.path.name,
+                    'offset': self.offset,
+                    'final': '1' if final else '0',
+                },
+                data=ThrottledBody(data, self.recorder.bandwidth, BandwidthManager.LIVE),
+                headers={'Content-Type': 'application/octet-stream'},
+                timeout=60
+            )
+            if response.status_code in (200, 409):
+                self.offset = response.json()['offset']
+                return response.status_code == 200 and self.offset == end
+            logger.warning(f"Fragment upload failed: {response.status_code}")
+        except (requests.exceptions.RequestException, OSError, ValueError) as e:
+            logger.warning(f"Fragment upload error: {e}")
+        return False
+
+
+class UploadSpool:
+    """Finished segments waiting for upload, uploaded by background workers.
+
+    Segments are moved into a spool directory, so anything not yet uploaded
+    is picked up again after a restart. Workers take the oldest segment first;
+    a failed upload stays in the spool and the worker backs off before retrying.
+    """
+
+    def __init__(self, directory, upload, workers=1, max_bytes=2 * 1024**3):
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True, parents=True)
+        self.upload = upload
+        self.max_bytes = max_bytes
+        self.in_progress = set()
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.threads = [
+            threading.Thread(target=self._run, name=f"upload-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def add(self, path):
+        """Move a finished segment into the spool and wake a worker"""
+        target = self.directory / path.name
+        path.replace(target)
+        # Upload state and hash sidecars travel with the video
+        for sidecar in path.parent.glob(path.name + '.*'):
+            sidecar.replace(target.with_name(sidecar.name))
+        with self.condition:
+            self.condition.notify()
+        return target
+
+    def pending(self):
+        # Segment names end with the recording timestamp, so name order is age order
+        return sorted(self.directory.glob('*.mp4'))
+
+    def size_bytes(self):
+        total = 0
+        for path in self.pending():
+            try:
+                total += path.stat().st_size
+            except FileNotFoundError:
+                pass  # Uploaded and deleted meanwhile
+        return total
+
+    def over_budget(self):
+        return self.size_bytes() > self.max_bytes
+
+    def _next(self):
+        with self.condition:
+            while not self.stop_event.is_set():
+                for path in self.pending():
+                    if path not in self.in_progress:
+                        self.in_progress.add(path)
+                        return path
+                self.condition.wait(timeout=5)
+        return None
+
+    def _run(self):
+        failures = 0
+        while not self.stop_event.is_set():
+            path = self._next()
+            if path is None:
+                break
+            try:
+                uploaded = self.upload(path)
+            except Exception as e:
+                logger.error(f"Error in upload worker: {e}", exc_info=True)
+                uploaded = False
+            with self.condition:
+                self.in_progress.discard(path)
+            if uploaded:
+                failures = 0
+                continue
+            failures += 1
+            delay = min(300, 10 * 2 ** (failures - 1))
+            logger.warning(f"Upload failures: {failures}; {len(self.pending())} segments spooled, "
+                           f"retrying in {delay} seconds")
+            self.stop_event.wait(delay)
+
+    def stop(self, timeout=5):
+        """Stop the workers; an interrupted upload resumes on the next start"""
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout=timeout)
+
+
+class DisplayGeometry:
+    """Cached capture size, re-checked with a cheap OS query.
+
+    The OS query (mss or GetSystemMetrics) only enumerates monitors and never
+    grabs pixels. The real frame size is probed with one capture, and only
+    again after the query reports a change, so HiDPI scaling between the
+    query and the capture does not look like a change.
+    """
+
+    def __init__(self, probe, monitor=None, check_interval=2.0):
+        self.probe = probe
+        self.monitor = monitor
+        self.check_interval = check_interval
+        self.size = None
+        self.reported = None
+        self.last_check = 0.0
+
+    def query(self):
+        """Current size from the OS, or None when there is no cheap query"""
+        try:
+            if mss is not None:
+                # A fresh instance re-enumerates monitors (the list is cached per instance)
+                with mss() as sct:
+                    monitor = sct.monitors[self.monitor or 0]
+                return (monitor['width'], monitor['height'])
+            if sys.platform == 'win32' and self.monitor is None:
+                user32 = ctypes.windll.user32
+                # SM_CXVIRTUALSCREEN / SM_CYVIRTUALSCREEN: all monitors combined
+                return (user32.GetSystemMetrics(78), user32.GetSystemMetrics(79))
+        except Exception as e:
+            logger.warning(f"Display query failed: {e}")
+        return None
+
+    def get(self):
+        if self.size is None:
+            self.reported = self.query()
+            self.size = self.probe()
+            self.last_check = time.monotonic()
+        return self.size
+
+    def changed(self):
+        """True if the OS reports a new resolution; at most one query per check_interval"""
+        now = time.monotonic()
+        if self.size is None or now - self.last_check < self.check_interval:
+            return False
+        self.last_check = now
+        reported = self.query()
+        if reported and reported != self.reported:
+            logger.info(f"Display resolution changed: {self.reported} -> {reported}")
+            # The capture size is probed again by the next get()
+            self.size = None
+            return True
+        return False
+
+    def update_from_frame(self, frame):
+        """Adopt the size of a captured frame; True if it differs from the cached one"""
+        size = (frame.shape[1], frame.shape[0])
+        if size == self.size:
+            return False
+        logger.info(f"Capture size changed: {self.size} -> {size}")
+        self.size = size
+        self.reported = self.query()
+        return True
+
+
+def list_monitors():
+    """Indexes of individual monitors (mss.monitors[1:]); empty without mss"""
+    if mss is None:
+        return []
+    with mss() as sct:
+        return list(range(1, len(sct.monitors)))
+
 
 class ScreenRecorder:
-    def __init__(self, server_ip="195.133.17.131", upload_interval=60):
+    def __init__(self, server_ip="195.133.17.131", upload_interval=60, fragment_seconds=None,
+                 monitor=None, bandwidth=None):
         self.server_ip = server_ip
+        # Monitor index (None = all screens in one frame); each monitor gets
+        # its own recordings, named machine_id + monitor index
+        self.monitor = monitor
+        self.running = True
         self.upload_interval = upload_interval  # seconds
+        # Fragmented MP4 mode: upload every N seconds while the segment is recording
+        self.fragment_seconds = fragment_seconds
+        self.fragment_uploader = None
+        self.segment_streamed = False
         self.is_recording = False
         self.current_video_file = None
         self.video_writer = None
+        self.ffmpeg_failed = False  # set after the ffmpeg encoder broke once
         self.fps = 6  # Lower FPS for Mac compatibility
+        self.base_fps = self.fps
         self.frame_count = 0
         self.last_upload_time = time.time()
         
@@ -42,6 +716,26 @@ class ScreenRecorder:
         self.output_dir = Path("temp_recordings") / self.machine_id
         self.output_dir.mkdir(exist_ok=True, parents=True)
         
+        # Captured frames are recycled through a small buffer pool
+        self.frame_pool = FramePool(max_buffers=2)
+        self.screen_capture = ScreenCapture(self.frame_pool, monitor or 0)
+        # Screen size is cached instead of grabbing a screenshot per segment
+        self.display = DisplayGeometry(self.probe_screen_size, monitor)
+        
+        # Finished segments are uploaded in the background from the spool, so
+        # recording never waits for the network
+        upload_workers = max(1, int(os.getenv('UPLOAD_WORKERS', '1')))
+        spool_max_mb = int(os.getenv('SPOOL_MAX_MB', '2048'))
+        
+        # Persistent keep-alive connection to the server, reused for every upload
+        self.http, self.http_adapter = create_http_session(pool_maxsize=upload_workers + 1)
+        # Upstream rate limit shared by fragment pushes (live) and segment uploads (bulk)
+        self.bandwidth = bandwidth or create_bandwidth_manager()
+        
+        suffix = f"_mon{monitor}" if monitor is not None else ""
+        self.spool = UploadSpool(self.output_dir / f"spool{suffix}", self.upload_video,
+                                 workers=upload_workers, max_bytes=spool_max_mb * 1024 * 1024)
+        
         # Setup log directory
         self.log_dir = Path("logs")
         self.log_dir.mkdir(exist_ok=True)
@@ -59,8 +753,13 @@ class ScreenRecorder:
     
     def get_screen_size(self):
         """Get current screen size"""
-        screenshot = ImageGrab.grab(all_screens=True)
-        return screenshot.size
+        return self.display.get()
+    
+    def probe_screen_size(self):
+        """Size of an actual captured frame (one capture)"""
+        frame = self.screen_capture.grab()
+        self.frame_pool.release(frame)
+        return (frame.shape[1], frame.shape[0])
     
     def start_recording(self):
         """Start recording screen"""
@@ -68,20 +767,41 @@ class ScreenRecorder:
         
         # Create filename with timestamp
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{self.machine_id}_{timestamp}.mp4"
+        suffix = f"_mon{self.monitor}" if self.monitor is not None else ""
+        filename = f"{self.machine_id}{suffix}_{timestamp}.mp4"
         self.current_video_file = self.output_dir / filename
         
         # Get screen resolution
         screen_width, screen_height = self.get_screen_size()
         
-        # Setup video writer
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        self.video_writer = cv2.VideoWriter(
-            str(self.current_video_file),
-            fourcc,
-            self.fps,
-            (screen_width, screen_height)
-        )
+        # Setup video writer: encode once through an ffmpeg pipe when available,
+        # otherwise mp4v via OpenCV (transcoded after the segment, if possible)
+        self.video_writer = None
+        ffmpeg = None if self.ffmpeg_failed else shutil.which('ffmpeg')
+        if ffmpeg:
+            try:
+                if self.fragment_seconds:
+                    # A keyframe starts every fragment, so each one can be uploaded on its own
+                    self.video_writer = FfmpegPipeWriter(
+                        ffmpeg, self.current_video_file, self.fps, (screen_width, screen_height),
+                        movflags='+frag_keyframe+empty_moov+default_base_moof',
+                        extra_args=('-g', str(int(self.fps * self.fragment_seconds)),
+                                    '-flush_packets', '1'))
+                    self.fragment_uploader = FragmentUploader(
+                        self, self.current_video_file, self.fragment_seconds)
+                else:
+                    self.video_writer = FfmpegPipeWriter(
+                        ffmpeg, self.current_video_file, self.fps, (screen_width, screen_height))
+            except OSError as e:
+                logger.warning(f"Could not start ffmpeg encoder: {e}")
+        if self.video_writer is None:
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+            self.video_writer = cv2.VideoWriter(
+                str(self.current_video_file),
+                fourcc,
+                self.fps,
+                (screen_width, screen_height)
+            )
         
         self.frame_count = 0
         logger.info(f"Started recording: {filename}")
@@ -89,15 +809,37 @@ class ScreenRecorder:
     def stop_recording(self):
         """Stop recording and save file"""
         self.is_recording = False
+        encoded_h264 = False
         if self.video_writer:
             self.video_writer.release()
+            if isinstance(self.video_writer, FfmpegPipeWriter):
+                encoded_h264 = not self.video_writer.failed
+                if self.video_writer.failed and not self.ffmpeg_failed:
+                    # Later segments go straight to cv2.VideoWriter
+                    self.ffmpeg_failed = True
+                    logger.warning("ffmpeg encoder failed; using OpenCV for the following segments")
             self.video_writer = None
         
+        self.segment_streamed = False
+        if self.fragment_uploader:
+            if encoded_h264:
+                self.segment_streamed = self.fragment_uploader.finish()
+                if not self.segment_streamed:
+                    # The server drops the partial copy once the full segment arrives
+                    logger.warning("Fragment upload incomplete; the segment will be uploaded whole")
+            else:
+                self.fragment_uploader.stop()
+            self.fragment_uploader = None
+        
         if self.current_video_file and self.current_video_file.exists():
             file_size = self.current_video_file.stat().st_size
             logger.info(f"Recording saved: {self.current_video_file.name} ({file_size/1024/1024:.2f} MB)")
-            # Try to transcode to H.264 for browser compatibility if ffmpeg is available
-            self._maybe_transcode_to_h264(self.current_video_file)
+            if not encoded_h264:
+                # Try to transcode to H.264 for browser compatibility if ffmpeg is available
+                self._maybe_transcode_to_h264(self.current_video_file)
+            if not self.segment_streamed:
+                # Hash while the file is still in the page cache
+                segment_sha256(self.current_video_file)
             return self.current_video_file
         return None
 
@@ -135,16 +877,14 @@ class ScreenRecorder:
     def capture_frame(self, bbox=None):
         """Capture single frame from screen"""
         try:
+            if bbox is None:
+                return self.screen_capture.grab()
+            
             # Grab screenshot - can capture specific screen with bbox
             screenshot = ImageGrab.grab(bbox=bbox, all_screens=True)
             
-            # Convert to numpy array
-            frame = np.array(screenshot)
-            
-            # Convert RGB to BGR (OpenCV format)
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-            
-            return frame
+            # Convert RGB/RGBA to BGR (OpenCV format) into a pooled buffer
+            return grab_to_bgr(screenshot, self.frame_pool)
         except Exception as e:
             logger.error(f"Error capturing frame: {e}")
             return None
@@ -152,9 +892,10 @@ class ScreenRecorder:
     def get_all_screens(self):
         """Get bounding boxes for all screens"""
         try:
-            # This captures all screens including multiple monitors
-            screenshot = ImageGrab.grab(all_screens=True)
-            return screenshot.size  # Returns combined size
+            # Combined size of all screens including multiple monitors
+            if self.monitor is None:
+                return self.display.get()
+            return DisplayGeometry(None).query() or ImageGrab.grab(all_screens=True).size
         except:
             # Fallback to single screen
             screenshot = ImageGrab.grab()
@@ -164,18 +905,33 @@ class ScreenRecorder:
         """Record for specified duration"""
         self.start_recording()
         
-        start_time = time.time()
-        frames_per_segment = self.fps * duration_seconds
+        # Control frame rate with absolute deadlines; segment length is wall-clock time
+        scheduler = FrameScheduler(self.fps, duration_seconds)
         
-        while self.is_recording and self.frame_count < frames_per_segment:
+        segment_size = self.get_screen_size()
+        # Slots not yet written (failed captures); the next captured frame fills them
+        pending = 0
+        
+        while self.is_recording and not scheduler.done():
+            pending += scheduler.wait() + 1
+            # A resolution change ends the segment; the next one uses the new size
+            if self.display.changed():
+                break
             frame = self.capture_frame()
             if frame is not None:
-                self.video_writer.write(frame)
-                self.frame_count += 1
-            
-            # Control frame rate
-            time.sleep(1.0 / self.fps)
+                if (frame.shape[1], frame.shape[0]) != segment_size:
+                    self.display.update_from_frame(frame)
+                    self.frame_pool.release(frame)
+                    break
+                # Repeat the frame for missed or failed slots so playback speed stays correct
+                for _ in range(pending):
+                    self.video_writer.write(frame)
+                self.frame_count += pending
+                pending = 0
+                self.frame_pool.release(frame)
         
+        if scheduler.dropped:
+            logger.info(f"Missed frame deadlines: {scheduler.dropped}")
         video_file = self.stop_recording()
         return video_file
     
@@ -195,41 +951,38 @@ class ScreenRecorder:
                 file_size = video_path.stat().st_size
                 logger.info(f"File size: {file_size / (1024*1024):.2f} MB")
                 
-                # Read the video file
-                with open(video_path, 'rb') as f:
-                    files = {'video': (video_path.name, f, 'video/mp4')}
-                    data = {
-                        'machine_id': self.machine_id,
-                        'timestamp': datetime.datetime.now().isoformat(),
-                        'client_version': '1.0'
-                    }
-                    
-                    # Upload to server with progress tracking
-                    start_time = time.time()
-                    response = requests.post(
-                        f"http://{self.server_ip}:5000/upload",
-                        files=files,
-                        data=data,
-                        timeout=600
-                    )
-                    
-                    upload_time = time.time() - start_time
-                    
-                    if response.status_code == 200:
-                        logger.info(f"✓ Uploaded successfully: {video_path.name} in {upload_time:.1f}s")
-                        # Delete local file after successful upload
-                        try:
-                            video_path.unlink()
-                        except Exception as e:
-                            logger.warning(f"Could not delete local file: {e}")
-                        return True
-                    else:
-                        logger.error(f"✗ Upload failed: {response.status_code} - {response.text}")
-                        if attempt < max_retries - 1:
-                            logger.info(f"Retrying in {retry_delay} seconds...")
-                            time.sleep(retry_delay)
-                        
-                return False
+                start_time = time.time()
+                # Resumable upload continues from the last committed chunk;
+                # servers without /upload/sessions get a single multipart POST
+                uploaded = self.upload_resumable(video_path)
+                if uploaded is None:
+                    uploaded = self.upload_multipart(video_path)
+                upload_time = time.time() - start_time
+                
+                if uploaded:
+                    self.last_upload_time = time.time()
+                    logger.info(f"✓ Uploaded successfully: {video_path.name} in {upload_time:.1f}s")
+                    stats = self.http_adapter.stats()
+                    logger.info(f"HTTP connections: {stats['connections']} for {stats['requests']} requests "
+                                f"({stats['reused']} reused)")
+                    if self.bandwidth.rate:
+                        usage = self.bandwidth.stats()
+                        logger.info(f"Bandwidth: live {usage['live']['bytes'] / (1024*1024):.1f} MB "
+                                    f"(throttled {usage['live']['throttled_s']}s), "
+                                    f"bulk {usage['bulk']['bytes'] / (1024*1024):.1f} MB "
+                                    f"(throttled {usage['bulk']['throttled_s']}s), "
+                                    f"live stream {usage['stream_bps'] * 8 // 1000} kbit/s")
+                    # Delete local file after successful upload
+                    try:
+                        video_path.unlink()
+                        remove_sidecars(video_path)
+                    except Exception as e:
+                        logger.warning(f"Could not delete local file: {e}")
+                    return True
+                
+                if attempt < max_retries - 1:
+                    logger.info(f"Retrying in {retry_delay} seconds...")
+                    time.sleep(retry_delay)
                         
             except requests.exceptions.RequestException as e:
                 logger.error(f"✗ Upload error: {e}")
@@ -244,66 +997,221 @@ class ScreenRecorder:
         logger.error("All upload attempts failed. Keeping local file.")
         return False
     
+    def upload_multipart(self, video_path):
+        """Legacy upload: the whole file in one multipart POST to /upload"""
+        # The body is encoded up front (as requests would) so it can be paced
+        body, content_type = encode_multipart_formdata({
+            'machine_id': self.machine_id,
+            'timestamp': datetime.datetime.now().isoformat(),
+            'client_version': '1.0',
+            'video': (video_path.name, video_path.read_bytes(), 'video/mp4'),
+        })
+        response = self.http.post(
+            f"http://{self.server_ip}:5000/upload",
+            data=ThrottledBody(body, self.bandwidth, BandwidthManager.BULK),
+            headers={
+                'Content-Type': content_type,
+                # Lets the server recognise a retry of this upload without storing the body
+                'X-Machine-ID': self.machine_id,
+                'X-Segment-Name': video_path.name,
+                'X-Content-SHA256': segment_sha256(video_path),
+            },
+            timeout=600
+        )
+        if response.status_code != 200:
+            logger.error(f"✗ Upload failed: {response.status_code} - {response.text}")
+            return False
+        if response.json().get('duplicate'):
+            logger.info(f"Server already has {video_path.name}")
+        return True
+    
+    def upload_resumable(self, video_path):
+        """Chunked upload through /upload/sessions that resumes from the committed offset.
+        
+        The upload id is kept next to the video in <name>.upload.json, so an
+        interrupted upload continues after a restart. Returns None when the
+        server has no resumable upload API.
+        """
+        base_url = f"http://{self.server_ip}:5000/upload/sessions"
+        state_path = video_path.with_name(video_path.name + '.upload.json')
+        file_size = video_path.stat().st_size
+        
+        state = None
+        offset = 0
+        if state_path.exists():
+            try:
+                state = json.loads(state_path.read_text())
+            except ValueError:
+                state = None
+        if state and state.get('size') == file_size:
+            response = self.http.get(f"{base_url}/{state['upload_id']}", timeout=30)
+            if response.status_code == 200:
+                offset = response.json()['offset']
+                logger.info(f"Resuming upload of {video_path.name} at {offset / (1024*1024):.2f} MB")
+            else:
+                state = None
+        else:
+            state = None
+        
+        if state is None:
+            state = {
+                'size': file_size,
+                'sha256': segment_sha256(video_path),
+                'timestamp': datetime.datetime.now().isoformat(),
+            }
+            response = self.http.post(base_url, json={
+                'machine_id': self.machine_id,
+                'filename': video_path.name,
+                'client_version': '1.0',
+                **state,
+            }, timeout=30)
+            if response.status_code in (404, 405):
+                return None
+            response.raise_for_status()
+            if response.json().get('duplicate'):
+                # Content is already stored (an earlier attempt got through)
+                logger.info(f"Server already has {video_path.name}")
+                return True
+            state['upload_id'] = response.json()['upload_id']
+            state_path.write_text(json.dumps(state))
+        
+        upload_url = f"{base_url}/{state['upload_id']}"
+        with open(video_path, 'rb') as f:
+            while offset < file_size:
+                f.seek(offset)
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                response = self.http.put(
+                    upload_url,
+                    params={'offset': offset},
+                    data=ThrottledBody(chunk, self.bandwidth, BandwidthManager.BULK),
+                    headers={'Content-Type': 'application/octet-stream'},
+                    timeout=120
+                )
+                # 409: the server has a different committed offset - continue from there
+                if response.status_code not in (200, 409):
+                    logger.error(f"✗ Chunk upload failed: {response.status_code} - {response.text}")
+                    return False
+                offset = response.json()['offset']
+        
+        response = self.http.post(f"{upload_url}/finalize", json={'sha256': state['sha256']}, timeout=120)
+        if response.status_code == 200:
+            state_path.unlink(missing_ok=True)
+            return True
+        logger.error(f"✗ Upload finalize failed: {response.status_code} - {response.text}")
+        if response.status_code == 400:
+            # Checksum mismatch: the server dropped the session, start over next time
+            state_path.unlink(missing_ok=True)
+        return False
+    
+    def resume_interrupted_uploads(self):
+        """Spool uploads that a previous version left half-done in output_dir"""
+        for state_path in sorted(self.output_dir.glob('*.upload.json')):
+            video_path = state_path.with_name(state_path.name[:-len('.upload.json')])
+            try:
+                if video_path.exists():
+                    logger.info(f"Found interrupted upload: {video_path.name}")
+                    self.spool.add(video_path)
+                else:
+                    state_path.unlink(missing_ok=True)
+            except FileNotFoundError:
+                pass  # Picked up by the recorder of another monitor
+    
+    def adjust_fps(self):
+        """Back-pressure: record at half the frame rate while the spool is over its disk budget"""
+        fps = max(1, self.base_fps // 2) if self.spool.over_budget() else self.base_fps
+        if fps != self.fps:
+            logger.warning(f"Upload spool {self.spool.size_bytes() / (1024*1024):.0f} MB "
+                           f"(budget {self.spool.max_bytes / (1024*1024):.0f} MB): FPS {self.fps} -> {fps}")
+            self.fps = fps
+    
     def run(self):
         """Main recording loop"""
         logger.info("=" * 60)
         logger.info("Starting Screen Recorder")
         logger.info("=" * 60)
         logger.info(f"Machine ID: {self.machine_id}")
+        if self.monitor is not None:
+            logger.info(f"Monitor: {self.monitor}")
         logger.info(f"Server: http://{self.server_ip}:5000")
         logger.info(f"Recording interval: {self.upload_interval} seconds")
+        if self.fragment_seconds:
+            logger.info(f"Fragment upload: every {self.fragment_seconds:g} seconds")
+        if self.bandwidth.rate:
+            logger.info(f"Upstream limit: {self.bandwidth.rate * 8 // 1000} kbit/s, live stream first "
+                        f"(bulk share at least {self.bandwidth.bulk_share:.0%})")
+            logger.info(f"Live rate report: {self.bandwidth.live_rate_file}")
         logger.info(f"FPS: {self.fps}")
         logger.info("Press Ctrl+C to stop")
         logger.info("=" * 60)
         
-        consecutive_failures = 0
-        max_failures = 3
-        
         try:
-            while True:
+            self.resume_interrupted_uploads()
+            pending = self.spool.pending()
+            if pending:
+                logger.info(f"Segments waiting for upload: {len(pending)}")
+
+            while self.running:
                 try:
+                    self.adjust_fps()
+                    
                     # Record a segment
                     logger.info(f"Starting new recording segment...")
                     video_file = self.record_segment(self.upload_interval)
                     
-                    # Upload the segment
+                    # Hand the segment to the upload workers (already on the server if it was streamed in fragments)
                     if video_file:
-                        upload_success = self.upload_video(video_file)
-                        if upload_success:
-                            consecutive_failures = 0
+                        if self.segment_streamed:
+                            logger.info(f"✓ Streamed to server in fragments: {video_file.name}")
+                            video_file.unlink(missing_ok=True)
                             self.last_upload_time = time.time()
                         else:
-                            consecutive_failures += 1
-                            logger.warning(f"Upload failures: {consecutive_failures}/{max_failures}")
+                            self.spool.add(video_file)
                     else:
                         logger.error("Failed to record video segment")
                     
-                    # If too many consecutive failures, wait longer before retry
-                    if consecutive_failures >= max_failures:
-                        logger.error("Too many consecutive failures. Waiting 60 seconds before retry...")
-                        time.sleep(60)
-                        consecutive_failures = 0
-                    
                 except Exception as e:
                     logger.error(f"Error in recording loop: {e}", exc_info=True)
                     time.sleep(10)  # Wait before retrying
                 
-                # Small delay before next recording
-                time.sleep(1)
-                
         except KeyboardInterrupt:
             logger.info("\nStopping screen recorder...")
             if self.is_recording:
                 self.stop_recording()
-            logger.info("Screen recorder stopped")
+        self.spool.stop()
+        self.http.close()
+        logger.info("Screen recorder stopped")
+    
+    def stop(self):
+        """Stop run() from another thread; the current segment is finished first"""
+        self.running = False
+        self.is_recording = False
 
 
 def main():
-    # Create recorder instance
-    recorder = ScreenRecorder()
+    # PER_MONITOR=true records every monitor separately instead of one combined canvas
+    monitors = list_monitors() if os.getenv('PER_MONITOR', '').lower() == 'true' else []
+    # FRAGMENT_SECONDS=N streams each segment to the server as fragmented MP4 every N seconds
+    fragment_seconds = float(os.getenv('FRAGMENT_SECONDS', '0')) or None
+    if len(monitors) < 2:
+        # Create recorder instance
+        recorder = ScreenRecorder(fragment_seconds=fragment_seconds)
+        
+        # Start recording loop
+        recorder.run()
+        return
     
-    # Start recording loop
-    recorder.run()
+    # One upstream budget for all monitors
+    bandwidth = create_bandwidth_manager()
+    recorders = [ScreenRecorder(monitor=index, bandwidth=bandwidth, fragment_seconds=fragment_seconds)
+                 for index in monitors]
+    threads = [threading.Thread(target=r.run, daemon=True) for r in recorders[1:]]
+    for thread in threads:
+        thread.start()
+    # The first monitor runs on the main thread so it receives Ctrl+C
+    recorders[0].run()
+    for recorder, thread in zip(recorders[1:], threads):
+        recorder.stop()
+        thread.join(timeout=60)
 
 
 if __name__ == "__main__":
@@ -5,12 +5,25 @@ Screen Recording Client с прямой трансляцией
 import cv2
 import numpy as np
 from PIL import ImageGrab
+try:
+    from mss import mss  # Быстрый захват прямо в буфер, если установлен
+except ImportError:
+    mss = None
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import sys
+import ctypes
+import json
 import socket
+import struct
+import tempfile
 import datetime
 import threading
+import queue
+from collections import deque
 from pathlib import Path
 import logging
 import base64
@@ -20,11 +33,466 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# urllib3 пишет предупреждение на каждый повтор подключения - ошибки логируем сами
+logging.getLogger('urllib3.connectionpool').setLevel(logging.ERROR)
+
+
+class FrameChangeDetector:
+    """Дешёвый детектор изменений: сравнивает уменьшенные отпечатки кадров.
+
+    Кадр уменьшается до thumbnail (INTER_AREA усредняет блоки пикселей),
+    переводится в оттенки серого и сравнивается с последним изменившимся
+    кадром. Сравниваем с последним *изменившимся*, а не с предыдущим,
+    чтобы медленные изменения накапливались и не терялись.
+    """
+
+    def __init__(self, threshold=4, size=(64, 36)):
+        self.threshold = threshold
+        self.size = size
+        self.reference = None
+        self.changed_frames = 0
+        self.unchanged_frames = 0
+
+    def fingerprint(self, frame):
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    def is_changed(self, frame):
+        """True если кадр отличается от последнего изменившегося больше порога"""
+        fp = self.fingerprint(frame)
+        if self.reference is None or int(cv2.absdiff(fp, self.reference).max()) > self.threshold:
+            self.reference = fp
+            self.changed_frames += 1
+            return True
+        self.unchanged_frames += 1
+        return False
+
+    def reset(self):
+        self.reference = None
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter с keep-alive пулом и статистикой переиспользования соединений.
+
+    urllib3 сам проверяет, не закрыто ли соединение сервером, и переподключается;
+    Retry(connect=...) повторяет запрос, если переподключиться сразу не удалось.
+    """
+
+    def __init__(self, pool_maxsize=2):
+        self.pools = []
+        super().__init__(pool_connections=1, pool_maxsize=pool_maxsize,
+                         max_retries=Retry(total=2, connect=2, read=0, backoff_factor=0.2))
+
+    def _track(self, pool):
+        if pool not in self.pools:
+            self.pools.append(pool)
+        return pool
+
+    def get_connection(self, *args, **kwargs):
+        return self._track(super().get_connection(*args, **kwargs))
+
+    def get_connection_with_tls_context(self, *args, **kwargs):
+        # requests >= 2.32 вызывает этот метод вместо get_connection
+        return self._track(super().get_connection_with_tls_context(*args, **kwargs))
+
+    def stats(self):
+        """Сколько запросов ушло и сколько TCP соединений для этого открыто"""
+        requests_sent = sum(pool.num_requests for pool in self.pools)
+        connections = sum(pool.num_connections for pool in self.pools)
+        return {
+            'requests': requests_sent,
+            'connections': connections,
+            'reused': max(0, requests_sent - connections),
+        }
+
+
+def create_http_session(pool_maxsize=2):
+    """Сессия requests с постоянными соединениями, живет все время работы клиента"""
+    session = requests.Session()
+    adapter = PooledHTTPAdapter(pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session, adapter
+
+
+class BandwidthManager:
+    """Token bucket исходящего канала для live-кадров.
+
+    Сегменты этой машины загружает client.py - другим процессом, поэтому
+    приоритет стрима над загрузками согласуется через файл: раз в секунду
+    менеджер записывает в rate_file текущую скорость live-трафика, а bucket
+    client.py пополняется на столько же медленнее (но не ниже своей доли
+    для загрузок). Кадр отправляется сразу, если в bucket есть токены;
+    иначе отправитель ждет, пока долг не будет оплачен.
+    """
+
+    LIVE = 'live'
+
+    def __init__(self, rate=None, rate_file=None):
+        self.rate = rate  # байт в секунду, None - без ограничения
+        self.rate_file = rate_file
+        self.burst = max(rate // 4, 64 * 1024) if rate else 0
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        self.bytes_sent = {self.LIVE: 0}
+        self.throttled_seconds = {self.LIVE: 0.0}
+        self.published_at = time.monotonic()
+        self.published_bytes = 0
+
+    def acquire(self, nbytes, priority=LIVE):
+        """Ждет, пока nbytes можно отправить"""
+        delay = 0.0
+        with self.lock:
+            if self.rate:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens <= 0:
+                    delay = -self.tokens / self.rate
+                self.tokens -= nbytes
+            self.bytes_sent[priority] += nbytes
+            self.throttled_seconds[priority] += delay
+            self._publish_rate()
+        if delay:
+            time.sleep(delay)
+
+    def _publish_rate(self):
+        """Скорость live-трафика за последнюю секунду - в rate_file для client.py"""
+        now = time.monotonic()
+        if not self.rate_file or now - self.published_at < 1:
+            return
+        sent = self.bytes_sent[self.LIVE]
+        report = {'bytes_per_second': (sent - self.published_bytes) / (now - self.published_at),
+                  'time': time.time()}
+        self.published_at, self.published_bytes = now, sent
+        try:
+            tmp = Path(f"{self.rate_file}.tmp")
+            tmp.write_text(json.dumps(report))
+            tmp.replace(self.rate_file)
+        except OSError as e:
+            logger.debug(f"Live rate report error: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {'bytes': self.bytes_sent[self.LIVE],
+                    'throttled_s': round(self.throttled_seconds[self.LIVE], 1)}
+
+
+# Общий с client.py файл отчета о скорости live-трафика
+DEFAULT_LIVE_RATE_FILE = Path(tempfile.gettempdir()) / 'screen_recorder_live_rate.json'
+
+
+def create_bandwidth_manager():
+    """BandwidthManager из UPLOAD_RATE_KBPS (килобит/с, тот же лимит, что у client.py)
+    и LIVE_RATE_FILE"""
+    rate_kbps = int(os.getenv('UPLOAD_RATE_KBPS', '0'))
+    return BandwidthManager(rate=rate_kbps * 1000 // 8 or None,
+                            rate_file=os.getenv('LIVE_RATE_FILE') or DEFAULT_LIVE_RATE_FILE)
+
+
+class LatestQueue:
+    """Ограниченная очередь с политикой drop-oldest: при переполнении
+    выбрасывается самый старый элемент, put() никогда не блокируется"""
+
+    def __init__(self, maxsize):
+        self.items = deque(maxlen=maxsize)
+        self.cond = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        with self.cond:
+            if not self.items:
+                self.cond.wait(timeout)
+            return self.items.popleft() if self.items else None
+
+
+class FramePool:
+    """Небольшой пул кадровых буферов одного размера.
+
+    Буфер берется через acquire(), а после записи/кодирования кадра
+    возвращается через release() и используется для следующего кадра,
+    вместо выделения нового массива на каждый кадр.
+    """
+
+    def __init__(self, max_buffers=4):
+        self.max_buffers = max_buffers
+        self.free = {}
+        self.lock = threading.Lock()
+        self.allocated = 0
+
+    def acquire(self, shape):
+        with self.lock:
+            buffers = self.free.get(shape)
+            if buffers:
+                return buffers.pop()
+            self.allocated += 1
+        return np.empty(shape, dtype=np.uint8)
+
+    def release(self, frame):
+        with self.lock:
+            buffers = self.free.setdefault(frame.shape, [])
+            if len(buffers) < self.max_buffers:
+                buffers.append(frame)
+
+
+class ScreenCapture:
+    """Захват экрана сразу в буферы из пула (BGR, как ждут VideoWriter и imencode).
+
+    С mss кадр BGRA читается прямо из буфера скриншота через np.frombuffer
+    (без копии) и конвертируется в BGR в готовый буфер. Без mss используется
+    PIL ImageGrab - тогда остается одна промежуточная копия в np.asarray.
+    """
+
+    def __init__(self, pool, monitor=0):
+        self.pool = pool
+        self.monitor = monitor  # индекс в mss.monitors, 0 - все экраны вместе
+        self.sct = None
+
+    def grab(self):
+        if mss is not None:
+            # mss создаем в потоке захвата - экземпляр не стоит делить между потоками
+            if self.sct is None:
+                self.sct = mss()
+            shot = self.sct.grab(self.sct.monitors[self.monitor])
+            src = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+            code = cv2.COLOR_BGRA2BGR
+        else:
+            src = np.asarray(ImageGrab.grab(all_screens=True))
+            code = cv2.COLOR_RGB2BGR
+        frame = self.pool.acquire((src.shape[0], src.shape[1], 3))
+        cv2.cvtColor(src, code, dst=frame)
+        return frame
+
+
+class FramePipeline:
+    """Конвейер захват -> кодирование/запись -> отправка.
+
+    Поток захвата только кладёт кадры в encode_queue. Стадия кодирования пишет
+    кадр в VideoWriter и, если нужно, кодирует JPEG для стрима. Стадия отправки
+    шлёт JPEG на сервер. Очередь стрима - drop-oldest, поэтому медленная сеть
+    теряет устаревшие кадры, а не тормозит захват.
+    """
+
+    def __init__(self, recorder, pool, queue_size=20, live_queue_size=2):
+        self.recorder = recorder
+        self.pool = pool
+        self.encode_queue = queue.Queue(maxsize=queue_size)
+        self.send_queue = LatestQueue(live_queue_size)
+        self.dropped_frames = 0
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.threads = [
+            threading.Thread(target=self._encode_loop, name="encoder", daemon=True),
+            threading.Thread(target=self._send_loop, name="sender", daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        self.encode_queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout=5)
+        self.threads = []
+
+    def submit(self, writer, frame, write=True, push_live=False, timeout=None, repeat=1):
+        """Передает кадр стадии кодирования. False - очередь полна, кадр потерян.
+        repeat - сколько раз записать кадр (заполнение пропущенных слотов)"""
+        try:
+            self.encode_queue.put((writer, frame, write, push_live, repeat), timeout=timeout)
+            return True
+        except queue.Full:
+            self.dropped_frames += 1
+            return False
+
+    def flush(self):
+        """Ждет, пока все поставленные кадры будут записаны"""
+        self.encode_queue.join()
+
+    def _encode_loop(self):
+        while True:
+            item = self.encode_queue.get()
+            try:
+                if item is None:
+                    break
+                writer, frame, write, push_live, repeat = item
+                if push_live:
+                    self.send_queue.put(self.recorder.encode_frame_for_stream(frame))
+                if write:
+                    for _ in range(repeat):
+                        writer.write(frame)
+                # Кадр больше не нужен - буфер возвращается в пул
+                self.pool.release(frame)
+            except Exception as e:
+                logger.error(f"Encoder stage error: {e}")
+            finally:
+                self.encode_queue.task_done()
+
+    def _send_loop(self):
+        # Основной путь - постоянный канал /api/ingest. Если сервер его не
+        # поддерживает или канал оборвался, кадры идут по одному на
+        # /api/upload_frame, а канал переоткрывается через 30 секунд
+        channel_retry_at = 0.0
+        while self.running:
+            if time.monotonic() >= channel_retry_at:
+                opened = time.monotonic()
+                try:
+                    self.recorder.stream_frames(self._channel_frames())
+                except Exception as e:
+                    logger.debug(f"Live channel error: {e}")
+                if not self.running:
+                    break
+                # Долго проработавший канал (перезапуск сервера) переоткрываем сразу
+                if time.monotonic() - opened < 30:
+                    logger.info("Live channel unavailable, sending frames one per request")
+                    channel_retry_at = time.monotonic() + 30
+            frame_bytes = self.send_queue.get(timeout=0.5)
+            if frame_bytes is not None:
+                self.recorder.send_frame_for_stream(frame_bytes)
+
+    def _channel_frames(self):
+        """Тело постоянного канала: кадры [4 байта длины][JPEG], пока конвейер работает"""
+        while self.running:
+            frame_bytes = self.send_queue.get(timeout=0.5)
+            if frame_bytes is not None:
+                self.recorder.bandwidth.acquire(4 + len(frame_bytes), BandwidthManager.LIVE)
+                yield struct.pack('>I', len(frame_bytes)) + frame_bytes
+
+
+class FrameScheduler:
+    """Планировщик кадров по абсолютным дедлайнам на monotonic часах.
+
+    Кадр n снимается в момент start + n / fps, поэтому время обработки кадра
+    не сдвигает расписание. Если захват опоздал, прошедшие слоты считаются
+    потерянными (dropped) - их можно заполнить повтором кадра, чтобы число
+    кадров в файле совпадало с fps контейнера.
+    """
+
+    def __init__(self, fps, duration=None):
+        self.interval = 1.0 / fps
+        self.total_frames = int(fps * duration) if duration else None
+        self.start = time.monotonic()
+        self.next_frame = 0
+        self.dropped = 0
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def done(self):
+        if self.total_frames is not None:
+            return self.next_frame >= self.total_frames
+        return False
+
+    def wait(self):
+        """Ждет дедлайн следующего кадра. Возвращает число пропущенных слотов"""
+        now = time.monotonic()
+        deadline = self.start + self.next_frame * self.interval
+        missed = 0
+        if now < deadline:
+            time.sleep(deadline - now)
+        else:
+            missed = int((now - deadline) / self.interval)
+            if self.total_frames is not None:
+                missed = min(missed, max(0, self.total_frames - self.next_frame - 1))
+        self.next_frame += missed + 1
+        self.dropped += missed
+        return missed
+
+
+class DisplayGeometry:
+    """Кэш размера захвата, который перепроверяется дешевым запросом к ОС.
+
+    Запрос к ОС (mss или GetSystemMetrics) только перечисляет мониторы и не
+    снимает скриншот. Реальный размер кадра берется одним захватом и заново -
+    только когда запрос показал смену разрешения, поэтому HiDPI масштаб
+    между запросом и захватом не считается сменой.
+    """
+
+    def __init__(self, probe, monitor=None, check_interval=2.0):
+        self.probe = probe
+        self.monitor = monitor
+        self.check_interval = check_interval
+        self.size = None
+        self.reported = None
+        self.last_check = 0.0
+
+    def query(self):
+        """Текущий размер от ОС или None, если дешевого запроса нет"""
+        try:
+            if mss is not None:
+                # Новый экземпляр заново перечисляет мониторы (список кэшируется в экземпляре)
+                with mss() as sct:
+                    monitor = sct.monitors[self.monitor or 0]
+                return (monitor['width'], monitor['height'])
+            if sys.platform == 'win32' and self.monitor is None:
+                user32 = ctypes.windll.user32
+                # SM_CXVIRTUALSCREEN / SM_CYVIRTUALSCREEN: все мониторы вместе
+                return (user32.GetSystemMetrics(78), user32.GetSystemMetrics(79))
+        except Exception as e:
+            logger.warning(f"Display query failed: {e}")
+        return None
+
+    def get(self):
+        if self.size is None:
+            self.reported = self.query()
+            self.size = self.probe()
+            self.last_check = time.monotonic()
+        return self.size
+
+    def changed(self):
+        """True, если ОС сообщает новое разрешение; запрос не чаще раза в check_interval"""
+        now = time.monotonic()
+        if self.size is None or now - self.last_check < self.check_interval:
+            return False
+        self.last_check = now
+        reported = self.query()
+        if reported and reported != self.reported:
+            logger.info(f"Display resolution changed: {self.reported} -> {reported}")
+            # Размер захвата заново определит следующий get()
+            self.size = None
+            return True
+        return False
+
+    def update_from_frame(self, frame):
+        """Берет размер снятого кадра; True, если он отличается от кэша"""
+        size = (frame.shape[1], frame.shape[0])
+        if size == self.size:
+            return False
+        logger.info(f"Capture size changed: {self.size} -> {size}")
+        self.size = size
+        self.reported = self.query()
+        return True
+
+
+def list_monitors():
+    """Индексы отдельных мониторов (mss.monitors[1:]); пусто, если mss нет"""
+    if mss is None:
+        return []
+    with mss() as sct:
+        return list(range(1, len(sct.monitors)))
+
 
 class ScreenRecorder:
-    def __init__(self, server_ip=None, upload_interval=300):  # 5 минут
+    def __init__(self, server_ip=None, upload_interval=300, monitor=None, bandwidth=None):  # 5 минут
         # Получаем из переменных окружения или используем значения по умолчанию
         self.machine_id = os.getenv('MACHINE_ID') or self.get_machine_id()
+        # Номер монитора (None - все экраны одним кадром). У каждого монитора
+        # свой стрим и свои записи: machine_id + номер монитора
+        self.monitor = monitor
+        self.running = True
         self.server_ip = server_ip or os.getenv('SERVER_HOST', 'localhost')
         self.server_port = int(os.getenv('SERVER_PORT', '6789'))
         
@@ -37,6 +505,15 @@ class ScreenRecorder:
         self.last_upload_time = time.time()
         self.is_streaming = True
         
+        # Детектор изменений: неизменившиеся кадры не отправляются в стрим.
+        # В запись они идут все: у cv2.VideoWriter постоянный fps и нет способа
+        # удлинить кадр, а пропуск записи ускорил бы воспроизведение
+        self.change_detector = FrameChangeDetector(threshold=int(os.getenv('CHANGE_THRESHOLD', '4')))
+        # Даже без изменений отправляем кадр раз в N секунд, чтобы стрим не считался упавшим
+        self.stream_keepalive = 2.0
+        self.last_stream_push = 0.0
+        self.stream_dirty = True
+        
         # Пишем в папку машины
         self.output_dir = Path("temp_recordings") / self.machine_id
         self.output_dir.mkdir(exist_ok=True, parents=True)
@@ -45,10 +522,24 @@ class ScreenRecorder:
         self.is_docker = os.path.exists('/.dockerenv')
         self.use_simulated = self.is_docker or os.getenv('SIMULATE_SCREEN', '').lower() == 'true'
         
-        # Поток для стрима
-        self.streaming_thread = None
+        # Конвейер кодирования и отправки кадров, буферы кадров переиспользуются
+        self.frame_pool = FramePool(max_buffers=4)
+        self.pipeline = FramePipeline(self, self.frame_pool, queue_size=self.fps * 2)
+        self.screen_capture = ScreenCapture(self.frame_pool, monitor or 0)
+        # Размер экрана кэшируется, а не снимается скриншотом на каждый сегмент
+        self.display = DisplayGeometry(self.probe_screen_size, monitor)
+        
+        # Статичный фон симуляции (градиент + имя машины), строится один раз
+        self.sim_background = None
+        
+        # Постоянное keep-alive соединение с сервером для стрима
+        self.http, self.http_adapter = create_http_session()
+        # Темп live-кадров; мониторы одной машины делят один канал
+        self.bandwidth = bandwidth or create_bandwidth_manager()
         
         logger.info(f"Screen Recorder initialized for machine: {self.machine_id}")
+        if self.monitor is not None:
+            logger.info(f"Monitor: {self.monitor}")
         logger.info(f"Server: http://{self.server_ip}:{self.server_port}")
         if self.use_simulated:
             logger.info("Using simulated screen (Docker mode)")
@@ -73,16 +564,21 @@ class ScreenRecorder:
         if self.use_simulated:
             return (1920, 1080)  # Стандартное разрешение для симуляции
         try:
-            screenshot = ImageGrab.grab(all_screens=True)
-            return screenshot.size
+            return self.display.get()
         except:
             return (1920, 1080)
     
+    def probe_screen_size(self):
+        """Размер реально снятого кадра (один захват)"""
+        frame = self.screen_capture.grab()
+        self.frame_pool.release(frame)
+        return (frame.shape[1], frame.shape[0])
+    
     def start_recording(self):
         self.is_recording = True
         
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{self.machine_id}_{timestamp}.mp4"
+        filename = f"{self.machine_id}{self.monitor_suffix()}_{timestamp}.mp4"
         self.current_video_file = self.output_dir / filename
         
         screen_width, screen_height = self.get_screen_size()
@@ -100,14 +596,38 @@ class ScreenRecorder:
         )
         
         self.frame_count = 0
+        self.change_detector.reset()
+        self.stream_dirty = True
+        
         logger.info(f"Started recording: {filename}")
     
     def stop_recording(self):
         self.is_recording = False
         if self.video_writer:
+            # Дописываем кадры, которые еще в очереди кодировщика
+            self.pipeline.flush()
             self.video_writer.release()
             self.video_writer = None
         
+        detector = self.change_detector
+        total = detector.changed_frames + detector.unchanged_frames
+        if total:
+            logger.info(f"Unchanged frames: {detector.unchanged_frames}/{total} "
+                        f"({detector.unchanged_frames * 100 // total}%)")
+        detector.changed_frames = detector.unchanged_frames = 0
+        if self.pipeline.dropped_frames or self.pipeline.send_queue.dropped:
+            logger.info(f"Dropped frames: recording={self.pipeline.dropped_frames}, "
+                        f"live={self.pipeline.send_queue.dropped}")
+            self.pipeline.dropped_frames = self.pipeline.send_queue.dropped = 0
+        usage = self.bandwidth.stats()
+        if usage['bytes']:
+            logger.info(f"Live traffic: {usage['bytes'] / (1024*1024):.1f} MB "
+                        f"(throttled {usage['throttled_s']}s)")
+        stats = self.http_adapter.stats()
+        if stats['requests']:
+            logger.info(f"HTTP connections: {stats['connections']} for {stats['requests']} requests "
+                        f"({stats['reused']} reused)")
+        
         if self.current_video_file and self.current_video_file.exists():
             file_size = self.current_video_file.stat().st_size
             logger.info(f"Recording saved: {self.current_video_file.name} ({file_size/1024/1024:.2f} MB)")
@@ -119,22 +639,18 @@ class ScreenRecorder:
         if self.use_simulated:
             return self.generate_simulated_frame()
         try:
-            screenshot = ImageGrab.grab(all_screens=True)
-            frame = np.array(screenshot)
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-            return frame
+            return self.screen_capture.grab()
         except Exception as e:
             logger.error(f"Error capturing frame: {e}")
             return None
     
-    def generate_simulated_frame(self):
-        """Генерирует тестовый кадр с именем машины"""
-        width, height = 1920, 1080
-        frame = np.ones((height, width, 3), dtype=np.uint8) * 50  # Темный фон
-        
-        # Создаем цветной градиент
-        for y in range(height):
-            frame[y, :] = [50 + (y % 100) // 2, 80 + (y % 150) // 2, 100 + (y % 100) // 2]
+    def build_simulated_background(self, width=1920, height=1080):
+        """Статичный слой симуляции: цветной градиент и имя машины"""
+        # Градиент зависит только от строки - считаем один столбец и растягиваем
+        y = np.arange(height)
+        column = np.stack([50 + (y % 100) // 2, 80 + (y % 150) // 2, 100 + (y % 100) // 2], axis=1)
+        background = np.ascontiguousarray(
+            np.broadcast_to(column.astype(np.uint8)[:, None, :], (height, width, 3)))
         
         # Добавляем текст с именем машины
         font = cv2.FONT_HERSHEY_SIMPLEX
@@ -148,34 +664,52 @@ class ScreenRecorder:
         y = (height + text_height) // 2
         
         # Тень текста
-        cv2.putText(frame, text, (x + 5, y + 5), font, font_scale, (0, 0, 0), thickness)
+        cv2.putText(background, text, (x + 5, y + 5), font, font_scale, (0, 0, 0), thickness)
         # Основной текст
-        cv2.putText(frame, text, (x, y), font, font_scale, (0, 255, 255), thickness)
+        cv2.putText(background, text, (x, y), font, font_scale, (0, 255, 255), thickness)
+        return background
+    
+    def generate_simulated_frame(self):
+        """Генерирует тестовый кадр с именем машины"""
+        if self.sim_background is None:
+            self.sim_background = self.build_simulated_background()
+        height, width = self.sim_background.shape[:2]
+        
+        # Анимируем - меняем яркость по кадрам. Скаляр добавляется с насыщением
+        # сразу в буфер из пула, без полноразмерного массива сдвига
+        frame_count_mod = (self.frame_count // 10) % 50
+        shift = (frame_count_mod // 2, frame_count_mod // 3, frame_count_mod // 4, 0)
+        frame = self.frame_pool.acquire(self.sim_background.shape)
+        cv2.add(self.sim_background, shift, dst=frame)
         
         # Добавляем время
+        font = cv2.FONT_HERSHEY_SIMPLEX
         time_str = time.strftime("%Y-%m-%d %H:%M:%S")
         (tw, th), _ = cv2.getTextSize(time_str, font, 1.5, 3)
         cv2.putText(frame, time_str, (width - tw - 50, 50), font, 1.5, (255, 255, 255), 3)
         
-        # Анимируем - меняем яркость по кадрам (создаем полный массив для добавления)
-        frame_count_mod = (self.frame_count // 10) % 50
-        brightness_shift = np.full((height, width, 3), 
-                                    [frame_count_mod // 2, frame_count_mod // 3, frame_count_mod // 4], 
-                                    dtype=np.uint8)
-        frame = cv2.add(frame, brightness_shift)
-        
         return frame
     
-    def send_frame_for_stream(self, frame):
-        """Отправка кадра для прямой трансляции"""
+    def encode_frame_for_stream(self, frame):
+        """Кодирует кадр в JPEG для прямой трансляции"""
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 50])
+        return buffer.tobytes()
+    
+    def monitor_suffix(self):
+        """Суффикс имени файла записи для отдельного монитора"""
+        return f"_mon{self.monitor}" if self.monitor is not None else ""
+    
+    def send_frame_for_stream(self, frame_bytes):
+        """Отправка JPEG кадра для прямой трансляции"""
+        params = {'machine_id': self.machine_id}
+        if self.monitor is not None:
+            params['monitor'] = self.monitor
         try:
-            # Кодируем кадр в JPEG
-            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 50])
-            frame_bytes = buffer.tobytes()
-            
-            # Отправляем на сервер
-            requests.post(
-                f"http://{self.server_ip}:{self.server_port}/api/upload_frame?machine_id={self.machine_id}",
+            # Отправляем на сервер в темпе, который позволяет канал
+            self.bandwidth.acquire(len(frame_bytes), BandwidthManager.LIVE)
+            self.http.post(
+                f"http://{self.server_ip}:{self.server_port}/api/upload_frame",
+                params=params,
                 data=frame_bytes,
                 timeout=1,
                 headers={'Content-Type': 'application/octet-stream', 'X-Machine-Id': self.machine_id}
@@ -183,26 +717,70 @@ class ScreenRecorder:
         except Exception as e:
             pass  # Тихий провал для стрима
     
+    def stream_frames(self, frames):
+        """Постоянный канал трансляции: одно chunked POST-тело на все кадры.
+        Возвращается, когда канал закрыт"""
+        params = {'machine_id': self.machine_id}
+        if self.monitor is not None:
+            params['monitor'] = self.monitor
+        response = self.http.post(
+            f"http://{self.server_ip}:{self.server_port}/api/ingest",
+            params=params,
+            data=frames,
+            timeout=(5, 30),
+            headers={'Content-Type': 'application/octet-stream', 'X-Machine-Id': self.machine_id}
+        )
+        if response.status_code != 200:
+            logger.debug(f"Live channel rejected: {response.status_code}")
+    
     def record_segment(self, duration_seconds=300):
         """Записывает сегмент и отправляет кадры для стрима"""
         self.start_recording()
         
-        start_time = time.time()
-        frames_per_segment = self.fps * duration_seconds
+        # Длительность сегмента - по часам, а не по числу кадров
+        scheduler = FrameScheduler(self.fps, duration_seconds)
+        segment_size = self.get_screen_size()
+        # Незаписанные слоты (пропущенные дедлайны, неудачный захват, полная
+        # очередь) заполняет следующий кадр, ушедший в конвейер
+        pending = 0
         
-        while self.is_recording and self.frame_count < frames_per_segment:
+        while self.is_recording and not scheduler.done():
+            pending += scheduler.wait() + 1
+            # Смена разрешения закрывает сегмент, следующий пишется в новом размере
+            if not self.use_simulated and self.display.changed():
+                break
             frame = self.capture_frame()
             if frame is not None:
-                # Сохраняем в видео
-                self.video_writer.write(frame)
+                if (frame.shape[1], frame.shape[0]) != segment_size:
+                    self.display.update_from_frame(frame)
+                    self.frame_pool.release(frame)
+                    break
+                if self.change_detector.is_changed(frame):
+                    self.stream_dirty = True
                 self.frame_count += 1
                 
-                # Отправляем для стрима (каждый 2-й кадр для более плавного стрима)
+                # Отправляем для стрима (каждый 2-й кадр), только если экран изменился
+                push_live = False
                 if self.is_streaming and self.frame_count % 2 == 0:
-                    self.send_frame_for_stream(frame)
-            
-            time.sleep(1.0 / self.fps)
+                    now = time.time()
+                    if self.stream_dirty or now - self.last_stream_push >= self.stream_keepalive:
+                        push_live = True
+                        self.last_stream_push = now
+                        self.stream_dirty = False
+                
+                # Пропущенные слоты заполняем повтором кадра, чтобы скорость
+                # воспроизведения совпадала с fps контейнера.
+                # Кодирование, запись и отправка идут в потоках конвейера
+                if self.pipeline.submit(
+                        self.video_writer, frame, True, push_live,
+                        timeout=1.0 / self.fps, repeat=pending):
+                    pending = 0
+                else:
+                    # Кадр не ушел в конвейер - сразу возвращаем буфер в пул
+                    self.frame_pool.release(frame)
         
+        if scheduler.dropped:
+            logger.info(f"Missed frame deadlines: {scheduler.dropped}")
         video_file = self.stop_recording()
         return video_file
     
@@ -213,13 +791,20 @@ class ScreenRecorder:
         logger.info(f"Machine ID: {self.machine_id}")
         logger.info(f"Server: http://{self.server_ip}:{self.server_port}")
         logger.info(f"Recording interval: {self.upload_interval} seconds")
-        logger.info(f"LIVE Stream: http://{self.server_ip}:{self.server_port}/live/{self.machine_id}")
+        live_url = f"http://{self.server_ip}:{self.server_port}/live/{self.machine_id}"
+        if self.monitor is not None:
+            live_url += f"?monitor={self.monitor}"
+        logger.info(f"LIVE Stream: {live_url}")
+        if self.bandwidth.rate:
+            logger.info(f"Upstream limit: {self.bandwidth.rate * 8 // 1000} kbit/s "
+                        f"(live rate report: {self.bandwidth.rate_file})")
         logger.info(f"FPS: {self.fps}")
         logger.info("Press Ctrl+C to stop")
         logger.info("=" * 60)
         
+        self.pipeline.start()
         try:
-            while True:
+            while self.running:
                 logger.info(f"Starting new recording segment...")
                 video_file = self.record_segment(self.upload_interval)
                 
@@ -227,18 +812,42 @@ class ScreenRecorder:
                     file_size = video_file.stat().st_size
                     logger.info(f"✅ Segment saved: {video_file.name} ({file_size/1024/1024:.2f} MB)")
                 
-                time.sleep(1)
+                if self.running:
+                    time.sleep(1)
                 
         except KeyboardInterrupt:
             logger.info("\nStopping screen recorder...")
             if self.is_recording:
                 self.stop_recording()
-            logger.info("Screen recorder stopped")
+        self.pipeline.stop()
+        self.http.close()
+        logger.info("Screen recorder stopped")
+    
+    def stop(self):
+        """Останавливает run() из другого потока, текущий сегмент дописывается"""
+        self.running = False
+        self.is_recording = False
 
 
 def main():
-    recorder = ScreenRecorder()
-    recorder.run()
+    # PER_MONITOR=true - отдельный стрим и отдельные записи на каждый монитор
+    monitors = list_monitors() if os.getenv('PER_MONITOR', '').lower() == 'true' else []
+    if len(monitors) < 2:
+        recorder = ScreenRecorder()
+        recorder.run()
+        return
+    
+    # Один бюджет исходящего канала на все мониторы
+    bandwidth = create_bandwidth_manager()
+    recorders = [ScreenRecorder(monitor=index, bandwidth=bandwidth) for index in monitors]
+    threads = [threading.Thread(target=r.run, daemon=True) for r in recorders[1:]]
+    for thread in threads:
+        thread.start()
+    # Первый монитор пишется в главном потоке - он же ловит Ctrl+C
+    recorders[0].run()
+    for recorder, thread in zip(recorders[1:], threads):
+        recorder.stop()
+        thread.join(timeout=30)
 
 
 if __name__ == "__main__":
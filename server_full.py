@@ -2,10 +2,23 @@
 Screen Recording Server с полным веб-интерфейсом
 """
 
-from flask import Flask, request, jsonify, send_from_directory, render_template_string
+from flask import Flask, Response, request, jsonify, send_from_directory, render_template_string
 from pathlib import Path
+import base64
+import collections
 import datetime
+import hashlib
+import json
 import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import cv2
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
 
 app = Flask(__name__)
 
@@ -14,6 +27,377 @@ UPLOAD_DIR = Path("/root/uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 SERVER_PORT = 5000
 
+# Блокировки файлов, в которые дописываются фрагменты: фиксированный набор,
+# файл выбирает свою по хешу пути (словарь по файлу рос бы без конца).
+# Две такие блокировки одновременно не берутся - у разных файлов она может совпасть
+APPEND_BUFFER_SIZE = 1024 * 1024
+APPEND_LOCK_STRIPES = 64
+append_locks = [threading.Lock() for _ in range(APPEND_LOCK_STRIPES)]
+
+def get_append_lock(filepath: Path) -> threading.Lock:
+    return append_locks[hash(str(filepath)) % APPEND_LOCK_STRIPES]
+
+def receive_multipart_upload(file_field: str):
+    """Потоковый разбор multipart без буферизации Werkzeug.
+    
+    Файл пишется кусками APPEND_BUFFER_SIZE сразу во временный .part в папке
+    машины (если machine_id пришел раньше файла, иначе в UPLOAD_DIR - та же
+    файловая система), так что потом его остается только переименовать.
+    Возвращает (form, filename, tmp_path, sha256 файла); tmp_path = None,
+    если файла нет.
+    """
+    boundary = parse_options_header(request.content_type or '')[1].get('boundary')
+    if not request.mimetype.startswith('multipart/') or not boundary:
+        return {}, None, None, None
+    
+    decoder = MultipartDecoder(boundary.encode())
+    form = {}
+    filename = None
+    tmp_path = None
+    out = None
+    field = None  # Имя текстового поля, которое сейчас читается
+    value = bytearray()
+    digest = hashlib.sha256()
+    try:
+        while True:
+            chunk = request.stream.read(APPEND_BUFFER_SIZE)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File):
+                    field = None
+                    if event.name == file_field and tmp_path is None:
+                        filename = Path(event.filename or '').name
+                        folder = UPLOAD_DIR / form['machine_id'] if 'machine_id' in form else UPLOAD_DIR
+                        folder.mkdir(exist_ok=True)
+                        tmp_path = folder / f".{uuid.uuid4().hex}.part"
+                        out = open(tmp_path, 'wb')
+                elif isinstance(event, Field):
+                    field = event.name
+                    value = bytearray()
+                elif isinstance(event, Data):
+                    if out is not None:
+                        out.write(event.data)
+                        digest.update(event.data)
+                        if not event.more_data:
+                            out.close()
+                            out = None
+                    elif field is not None:
+                        value += event.data
+                        if len(value) > 64 * 1024:
+                            raise ValueError(f'Form field too large: {field}')
+                        if not event.more_data:
+                            form[field] = value.decode('utf-8', 'replace')
+                event = decoder.next_event()
+            if isinstance(event, Epilogue) or not chunk:
+                break
+        if out is not None:
+            raise ValueError('Incomplete multipart body')
+    except Exception:
+        if out is not None:
+            out.close()
+        if tmp_path is not None:
+            tmp_path.unlink(missing_ok=True)
+        raise
+    return form, filename, tmp_path, digest.hexdigest()
+
+# Докачиваемые загрузки: метаданные <id>.json и принятые байты <id>.part
+SESSIONS_DIR = UPLOAD_DIR / "_sessions"
+SESSIONS_DIR.mkdir(exist_ok=True)
+
+def load_upload_session(upload_id: str):
+    if not upload_id or not all(c in '0123456789abcdef' for c in upload_id):
+        return None
+    meta = SESSIONS_DIR / f"{upload_id}.json"
+    if not meta.exists():
+        return None
+    return json.loads(meta.read_text())
+
+def save_upload_session(upload_id: str, session: dict):
+    meta = SESSIONS_DIR / f"{upload_id}.json"
+    tmp = meta.with_suffix('.tmp')
+    tmp.write_text(json.dumps(session))
+    tmp.replace(meta)
+
+# Сессии, которые не менялись столько секунд, удаляются: завершенные (повторный
+# finalize уже не придет) и брошенные вместе с принятыми байтами
+UPLOAD_SESSION_EXPIRY = int(os.getenv('UPLOAD_SESSION_EXPIRY', str(3 * 24 * 3600)))
+
+def expire_upload_sessions():
+    while True:
+        deadline = time.time() - UPLOAD_SESSION_EXPIRY
+        last_change = {}
+        for entry in os.scandir(SESSIONS_DIR):
+            upload_id = entry.name.partition('.')[0]
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            last_change[upload_id] = max(last_change.get(upload_id, 0), mtime)
+        expired = [upload_id for upload_id, mtime in last_change.items() if mtime < deadline]
+        for upload_id in expired:
+            with get_append_lock(SESSIONS_DIR / f"{upload_id}.part"):
+                for suffix in ('.json', '.tmp', '.part'):
+                    (SESSIONS_DIR / f"{upload_id}{suffix}").unlink(missing_ok=True)
+        if expired:
+            print(f"[UPLOAD] Удалено устаревших сессий загрузки: {len(expired)}")
+        time.sleep(3600)
+
+threading.Thread(target=expire_upload_sessions, daemon=True).start()
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(APPEND_BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Индекс загрузок: (machine_id, исходное имя сегмента, sha256) -> путь файла
+# относительно UPLOAD_DIR. Узнает только повтор той же загрузки (таймаут,
+# потерянный ответ, перезапуск клиента): одинаковые по содержимому сегменты
+# разных машин или разного времени (простой, экран блокировки) сохраняются
+# каждый. Хранится журналом строк JSON, чтобы повтор узнавался и после перезапуска
+HASH_INDEX_FILE = UPLOAD_DIR / "_hash_index.jsonl"
+hash_index = {}
+hash_index_lock = threading.Lock()
+
+def upload_key(machine_id: str, name: str, sha256: str):
+    return (machine_id or 'unknown', Path(name or '').name, (sha256 or '').lower())
+
+if HASH_INDEX_FILE.exists():
+    for line in HASH_INDEX_FILE.read_text().splitlines():
+        try:
+            entry = json.loads(line)
+            # Старые записи без machine_id и имени сегмента не годятся для проверки повтора
+            hash_index[upload_key(entry['machine_id'], entry['name'], entry['sha256'])] = entry['path']
+        except (ValueError, KeyError):
+            pass
+
+def find_by_hash(machine_id: str, name: str, sha256: str):
+    """Файл, уже сохраненный этой же загрузкой, или None"""
+    if not sha256 or not name:
+        return None
+    key = upload_key(machine_id, name, sha256)
+    with hash_index_lock:
+        relative = hash_index.get(key)
+        if relative is None:
+            return None
+        path = UPLOAD_DIR / relative
+        if not path.exists():
+            # Файл удалили - запись устарела
+            del hash_index[key]
+            return None
+        return path
+
+def add_to_hash_index(machine_id: str, name: str, sha256: str, path: Path):
+    key = upload_key(machine_id, name, sha256)
+    relative = path.relative_to(UPLOAD_DIR).as_posix()
+    with hash_index_lock:
+        hash_index[key] = relative
+        with open(HASH_INDEX_FILE, 'a') as f:
+            f.write(json.dumps({'machine_id': key[0], 'name': key[1], 'sha256': key[2],
+                                'path': relative}) + '\n')
+
+# Индекс записей в SQLite: списки машин и видео - запрос к базе, а не обход
+# папок со stat() каждого файла. Обновляется при загрузке, при запуске
+# досканируются только новые и измененные файлы
+RECORDINGS_DB = UPLOAD_DIR / "_recordings.db"
+SEGMENT_TIME_RE = re.compile(r'(\d{8}_\d{6})\.mp4$')
+recordings_lock = threading.Lock()
+recordings_db = sqlite3.connect(str(RECORDINGS_DB), check_same_thread=False)
+recordings_db.executescript("""
+    PRAGMA journal_mode=WAL;
+    CREATE TABLE IF NOT EXISTS recordings (
+        machine_id TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        start_time REAL,
+        end_time REAL,
+        duration REAL,
+        codec TEXT,
+        width INTEGER,
+        height INTEGER,
+        PRIMARY KEY (machine_id, filename)
+    );
+    CREATE INDEX IF NOT EXISTS recordings_by_time ON recordings (machine_id, start_time, filename);
+""")
+
+def query_recordings(sql: str, params=()):
+    with recordings_lock:
+        return recordings_db.execute(sql, params).fetchall()
+
+def probe_video(path: Path) -> dict:
+    """Длительность, кодек и размер кадра из заголовка mp4"""
+    cap = cv2.VideoCapture(str(path))
+    try:
+        if not cap.isOpened():
+            return {}
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+        return {
+            'duration': frames / fps if fps > 0 and frames > 0 else None,
+            'codec': fourcc.to_bytes(4, 'little').decode('latin-1').strip('\x00 ') or None,
+            'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or None,
+            'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or None,
+        }
+    finally:
+        cap.release()
+
+def recording_start(filename: str, mtime: float, duration) -> float:
+    """Начало записи: время из имени сегмента (..._20240101_120000.mp4),
+    иначе время изменения файла минус длительность"""
+    match = SEGMENT_TIME_RE.search(filename)
+    if match:
+        try:
+            return datetime.datetime.strptime(match.group(1), '%Y%m%d_%H%M%S').timestamp()
+        except ValueError:
+            pass
+    return mtime - (duration or 0)
+
+def index_recording(path: Path, probe: bool = True, notify: bool = True):
+    """Добавить или обновить запись в индексе; probe=False - только размер
+    (файл еще дописывается), notify - отправить событие дашборду"""
+    st = path.stat()
+    meta = probe_video(path) if probe else {}
+    duration = meta.get('duration')
+    start = recording_start(path.name, st.st_mtime, duration)
+    with recordings_lock, recordings_db:
+        previous = recordings_db.execute("SELECT size FROM recordings WHERE machine_id = ? AND filename = ?",
+                                         (path.parent.name, path.name)).fetchone()
+        recordings_db.execute(
+            "INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path.parent.name, path.name, st.st_size, st.st_mtime, start,
+             start + duration if duration else st.st_mtime, duration,
+             meta.get('codec'), meta.get('width'), meta.get('height')))
+    if notify:
+        publish_machine_change(path.parent.name, 'upload' if probe else 'append', filename=path.name,
+                               size_delta=st.st_size - (previous[0] if previous else 0))
+
+def forget_recording(machine_id: str, filename: str):
+    """Убрать запись из индекса; событие дашборду - только если она там была
+    (запросы несуществующих файлов не должны сбрасывать ETag)"""
+    with recordings_lock, recordings_db:
+        removed = recordings_db.execute("DELETE FROM recordings WHERE machine_id = ? AND filename = ?",
+                                        (machine_id, filename)).rowcount
+    if removed:
+        publish_machine_change(machine_id, 'removed', filename=filename)
+
+def sync_recordings_index():
+    """Сверка индекса с диском: новые и измененные (размер, mtime) файлы
+    индексируются, удаленные убираются из базы"""
+    known = {(machine_id, filename): (size, mtime) for machine_id, filename, size, mtime
+             in query_recordings("SELECT machine_id, filename, size, mtime FROM recordings")}
+    updated = 0
+    for folder in UPLOAD_DIR.iterdir():
+        if not folder.is_dir() or folder.name.startswith('_'):
+            continue
+        for entry in os.scandir(folder):
+            if not entry.name.endswith('.mp4') or not entry.is_file():
+                continue
+            st = entry.stat()
+            if known.pop((folder.name, entry.name), None) != (st.st_size, st.st_mtime):
+                try:
+                    index_recording(Path(entry.path), notify=False)
+                    updated += 1
+                except OSError:
+                    pass
+    with recordings_lock, recordings_db:
+        recordings_db.executemany("DELETE FROM recordings WHERE machine_id = ? AND filename = ?", list(known))
+    print(f"[INDEX] Индекс записей: обновлено {updated}, удалено {len(known)}")
+    if updated or known:
+        # Изменений может быть много - дашборды перечитают список целиком
+        publish_dashboard_event('resync', {})
+
+# События дашборда (Server-Sent Events): загрузка, дозапись, удаление,
+# машина в сети / не в сети. Каждое изменение увеличивает номер версии -
+# он же ETag для /api/machines, так что опрос без изменений стоит 304
+DASHBOARD_EPOCH = uuid.uuid4().hex[:8]
+MACHINE_ONLINE_TIMEOUT = int(os.getenv('MACHINE_ONLINE_TIMEOUT', '180'))
+SSE_KEEPALIVE = 25
+dashboard_events = collections.deque(maxlen=1000)
+dashboard_seq = 0
+dashboard_condition = threading.Condition()
+machine_last_seen = {}
+machines_online = set()
+
+def dashboard_etag() -> str:
+    return f"{DASHBOARD_EPOCH}-{dashboard_seq}"
+
+def publish_dashboard_event(name: str, data: dict):
+    global dashboard_seq
+    with dashboard_condition:
+        dashboard_seq += 1
+        dashboard_events.append((dashboard_seq, name, json.dumps(data)))
+        dashboard_condition.notify_all()
+
+def machine_summary(machine_id: str):
+    """Карточка машины для дашборда или None, если записей нет"""
+    count, total_size, last_upload = query_recordings(
+        "SELECT COUNT(*), SUM(size), MAX(mtime) FROM recordings WHERE machine_id = ?", (machine_id,))[0]
+    if not count:
+        return None
+    return {
+        'video_count': count,
+        'total_size': total_size,
+        'last_upload': datetime.datetime.fromtimestamp(last_upload).isoformat(),
+        'online': machine_id in machines_online
+    }
+
+def publish_machine_change(machine_id: str, change: str, **details):
+    publish_dashboard_event('machine', {
+        'machine_id': machine_id,
+        'change': change,
+        **details,
+        'machine': machine_summary(machine_id)
+    })
+
+def touch_machine(machine_id: str):
+    """Машина прислала данные - она в сети"""
+    machine_last_seen[machine_id] = time.monotonic()
+    if machine_id not in machines_online:
+        machines_online.add(machine_id)
+        publish_machine_change(machine_id, 'online')
+
+def watch_machines_online():
+    """Машина, которая ничего не присылала MACHINE_ONLINE_TIMEOUT секунд, - не в сети"""
+    while True:
+        time.sleep(10)
+        deadline = time.monotonic() - MACHINE_ONLINE_TIMEOUT
+        for machine_id in list(machines_online):
+            if machine_last_seen.get(machine_id, 0) < deadline:
+                machines_online.discard(machine_id)
+                publish_machine_change(machine_id, 'offline')
+
+threading.Thread(target=watch_machines_online, daemon=True).start()
+threading.Thread(target=sync_recordings_index, daemon=True).start()
+
+def discard_partial_append(machine_folder: Path, original_name: str):
+    """Сегмент, который не удалось дописать фрагментами (/upload/append), клиент
+    загрузил целиком под новым именем - недописанная копия под исходным именем
+    больше не нужна"""
+    partial = machine_folder / original_name
+    with get_append_lock(partial):
+        if not partial.exists():
+            return
+        partial.unlink()
+    forget_recording(machine_folder.name, original_name)
+    print(f"[UPLOAD] {machine_folder.name}: недописанный {original_name} заменен полной загрузкой")
+
+def duplicate_response(path: Path):
+    """Ответ на повторную загрузку уже сохраненного файла"""
+    file_size = path.stat().st_size
+    print(f"[UPLOAD] {path.parent.name}: {path.name} уже загружен, дубликат пропущен")
+    return jsonify({
+        'status': 'success',
+        'message': 'Файл уже загружен',
+        'duplicate': True,
+        'machine_id': path.parent.name,
+        'filename': path.name,
+        'size_mb': round(file_size / (1024*1024), 2)
+    })
+
 # HTML Dashboard
 DASHBOARD_HTML = """
 <!DOCTYPE html>
@@ -54,6 +438,7 @@ DASHBOARD_HTML = """
             font-size: 0.9em; font-weight: bold;
             background: #4CAF50; color: white;
         }
+        .machine-status.offline { background: #9e9e9e; }
         .machine-info { color: #666; margin-bottom: 10px; }
         .view-btn {
             width: 100%; padding: 12px;
@@ -94,6 +479,9 @@ DASHBOARD_HTML = """
             cursor: pointer; font-weight: bold;
         }
         .video-btn:hover { background: #45a049; }
+        .video-filters { margin-top: 15px; color: #666; }
+        .video-filters input { padding: 5px; margin: 0 10px 0 5px; }
+        #video-sentinel { height: 1px; }
         .live-indicator {
             background: red; color: white; padding: 3px 10px;
             border-radius: 15px; font-size: 0.8em; font-weight: bold;
@@ -115,7 +503,12 @@ DASHBOARD_HTML = """
         <div class="modal-content">
             <span class="close">&times;</span>
             <h2 id="modal-title"></h2>
+            <div class="video-filters">
+                с <input type="datetime-local" id="video-since" onchange="reloadVideos()">
+                по <input type="datetime-local" id="video-until" onchange="reloadVideos()">
+            </div>
             <div id="video-list"></div>
+            <div id="video-sentinel"></div>
         </div>
     </div>
 
@@ -147,7 +540,7 @@ DASHBOARD_HTML = """
                     <div class="machine-card">
                         <div class="machine-header">
                             <div class="machine-name">${machineId}</div>
-                            <div class="machine-status">🟢 Активен</div>
+                            <div class="machine-status${machines[machineId].online ? '' : ' offline'}">${machines[machineId].online ? '🟢 Активен' : '⚪ Не в сети'}</div>
                         </div>
                         <div class="machine-info">📁 ${machines[machineId].video_count} видео</div>
                         <div class="machine-info">📊 ${(machines[machineId].total_size / (1024*1024)).toFixed(2)} MB</div>
@@ -156,48 +549,112 @@ DASHBOARD_HTML = """
                 `).join('') + '</div>';
         }
         
-        async function viewVideos(machineId) {
+        // Список записей грузится страницами: следующая - когда пользователь
+        // докрутил модальное окно до конца
+        const VIDEO_PAGE_SIZE = 60;
+        let videoQuery = null;
+        
+        function viewVideos(machineId) {
+            document.getElementById('video-since').value = '';
+            document.getElementById('video-until').value = '';
+            document.getElementById('modal-title').textContent = `Записи: ${machineId}`;
+            document.getElementById('videoModal').style.display = 'block';
+            startVideoQuery(machineId);
+        }
+        
+        function reloadVideos() {
+            if (videoQuery) startVideoQuery(videoQuery.machineId);
+        }
+        
+        function startVideoQuery(machineId) {
+            document.getElementById('video-list').innerHTML = '';
+            videoQuery = { machineId: machineId, cursor: null, done: false, loading: false };
+            loadMoreVideos();
+        }
+        
+        async function loadMoreVideos() {
+            const query = videoQuery;
+            if (!query || query.loading || query.done) return;
+            query.loading = true;
             try {
-                const response = await fetch(`/api/videos/${machineId}`);
-                const videos = await response.json();
+                const params = new URLSearchParams({ limit: VIDEO_PAGE_SIZE });
+                const since = document.getElementById('video-since').value;
+                const until = document.getElementById('video-until').value;
+                if (since) params.set('since', since);
+                if (until) params.set('until', until);
+                if (query.cursor) params.set('cursor', query.cursor);
                 
-                document.getElementById('modal-title').textContent = `Записи: ${machineId}`;
-                const videoList = document.getElementById('video-list');
+                const response = await fetch(`/api/videos/${encodeURIComponent(query.machineId)}?${params}`);
+                const page = await response.json();
+                // Пока шел запрос, открыли другую машину или сменили фильтр
+                if (query !== videoQuery) return;
                 
-                if (videos.length === 0) {
+                const videoList = document.getElementById('video-list');
+                if (!query.cursor && page.videos.length === 0) {
                     videoList.innerHTML = '<p>Нет видео</p>';
-                } else {
-                    videoList.innerHTML = videos.map(video => `
-                        <div class="video-item">
-                            <div class="video-title">${video.filename}</div>
-                            <div class="video-info">📅 ${video.timestamp}</div>
-                            <div class="video-info">📦 ${video.size_mb} MB</div>
-                            <button class="video-btn" onclick="window.open('${video.url}', '_blank')">
-                                ▶️ Смотреть
-                            </button>
-                        </div>
-                    `).join('');
                 }
-                
-                document.getElementById('videoModal').style.display = 'block';
+                videoList.insertAdjacentHTML('beforeend', page.videos.map(video => `
+                    <div class="video-item">
+                        <div class="video-title">${video.filename}</div>
+                        <div class="video-info">📅 ${video.timestamp}</div>
+                        <div class="video-info">📦 ${video.size_mb} MB</div>
+                        <button class="video-btn" onclick="window.open('${video.url}', '_blank')">
+                            ▶️ Смотреть
+                        </button>
+                    </div>
+                `).join(''));
+                query.cursor = page.next_cursor;
+                query.done = !page.next_cursor;
             } catch (error) {
+                query.done = true;
                 alert('Ошибка загрузки видео');
+            } finally {
+                query.loading = false;
+            }
+            // Страница не заполнила окно - наблюдатель сработает еще раз
+            if (query === videoQuery && !query.done) {
+                videoObserver.unobserve(videoSentinel);
+                videoObserver.observe(videoSentinel);
             }
         }
         
+        const videoSentinel = document.getElementById('video-sentinel');
+        const videoObserver = new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) loadMoreVideos();
+        }, { root: document.querySelector('.modal-content'), rootMargin: '600px' });
+        videoObserver.observe(videoSentinel);
+        
         document.querySelector('.close').onclick = function() {
             document.getElementById('videoModal').style.display = 'none';
+            videoQuery = null;
         }
         
         window.onclick = function(event) {
             const modal = document.getElementById('videoModal');
             if (event.target == modal) {
                 modal.style.display = 'none';
+                videoQuery = null;
             }
         }
         
-        loadMachines();
-        setInterval(loadMachines, 5000);
+        // Изменения приходят событиями; без EventSource - опрос, который
+        // при неизменном состоянии получает 304 по ETag
+        if (window.EventSource) {
+            const events = new EventSource('/api/events');
+            events.addEventListener('machine', event => {
+                const change = JSON.parse(event.data);
+                if (change.machine) {
+                    machines[change.machine_id] = change.machine;
+                } else {
+                    delete machines[change.machine_id];
+                }
+                displayMachines();
+            });
+            events.addEventListener('resync', loadMachines);
+        } else {
+            loadMachines();
+            setInterval(loadMachines, 5000);
+        }
     </script>
 </body>
 </html>
@@ -211,25 +668,42 @@ def index():
 def upload_file():
     """Прием видео файлов"""
     try:
-        if 'video' not in request.files:
-            return jsonify({'error': 'No video file'}), 400
+        # Эта загрузка уже сохранена - отвечаем до чтения тела запроса
+        existing = find_by_hash(request.headers.get('X-Machine-ID'), request.headers.get('X-Segment-Name'),
+                                request.headers.get('X-Content-SHA256'))
+        if existing:
+            return duplicate_response(existing)
         
-        video = request.files['video']
-        if video.filename == '':
+        # Файл пишется прямо в папку машины и появляется в ней только целиком
+        form, original_name, tmp_path, sha256 = receive_multipart_upload('video')
+        if tmp_path is None:
+            return jsonify({'error': 'No video file'}), 400
+        if not original_name:
+            tmp_path.unlink(missing_ok=True)
             return jsonify({'error': 'No file selected'}), 400
         
+        # Повтор после таймаута на клиенте: содержимое уже сохранено
         # Получаем machine_id
-        machine_id = request.form.get('machine_id', 'unknown')
-        timestamp = request.form.get('timestamp', datetime.datetime.now().isoformat())
+        machine_id = form.get('machine_id', 'unknown')
+        existing = find_by_hash(machine_id, original_name, sha256)
+        if existing:
+            tmp_path.unlink(missing_ok=True)
+            return duplicate_response(existing)
+        
+        touch_machine(machine_id)
+        timestamp = form.get('timestamp', datetime.datetime.now().isoformat())
         
         # Создаем папку для машины
         machine_folder = UPLOAD_DIR / machine_id
         machine_folder.mkdir(exist_ok=True)
         
-        # Сохраняем файл
-        filename = f"{timestamp.replace(':', '-')}_{video.filename}"
+        # Атомарно переименовываем готовый файл
+        filename = f"{timestamp.replace(':', '-')}_{original_name}"
         filepath = machine_folder / filename
-        video.save(filepath)
+        tmp_path.replace(filepath)
+        add_to_hash_index(machine_id, original_name, sha256, filepath)
+        index_recording(filepath)
+        discard_partial_append(machine_folder, original_name)
         
         file_size = filepath.stat().st_size
         
@@ -247,44 +721,269 @@ def upload_file():
         print(f"Upload error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/upload/append', methods=['POST'])
+def upload_append():
+    """Дозапись фрагментов fMP4 в файл, пока клиент еще записывает сегмент"""
+    machine_id = request.args.get('machine_id', 'unknown')
+    filename = Path(request.args.get('filename', '')).name
+    if not filename.endswith('.mp4'):
+        return jsonify({'error': 'Bad filename'}), 400
+    try:
+        offset = int(request.args.get('offset', '0'))
+    except ValueError:
+        return jsonify({'error': 'Bad offset'}), 400
+    final = request.args.get('final') == '1'
+    touch_machine(machine_id)
+    
+    machine_folder = UPLOAD_DIR / machine_id
+    machine_folder.mkdir(exist_ok=True)
+    filepath = machine_folder / filename
+    
+    with get_append_lock(filepath):
+        size = filepath.stat().st_size if filepath.exists() else 0
+        if offset != size:
+            # Клиент продолжит с того места, где файл на самом деле заканчивается
+            return jsonify({'error': 'Offset mismatch', 'offset': size}), 409
+        with open(filepath, 'ab') as f:
+            shutil.copyfileobj(request.stream, f, APPEND_BUFFER_SIZE)
+        size = filepath.stat().st_size
+        index_recording(filepath, probe=final)
+    
+    if final:
+        add_to_hash_index(machine_id, filename, file_sha256(filepath), filepath)
+        print(f"[UPLOAD] {machine_id}: {filename} ({size/(1024*1024):.2f} MB, fragmented)")
+    return jsonify({'status': 'ok', 'offset': size, 'final': final})
+
+@app.route('/upload/sessions', methods=['POST'])
+def upload_session_create():
+    """Начало докачиваемой загрузки: клиент получает upload_id"""
+    data = request.get_json(silent=True) or request.form
+    machine_id = data.get('machine_id', 'unknown')
+    filename = Path(data.get('filename', '')).name
+    if not filename:
+        return jsonify({'error': 'No filename'}), 400
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Bad size'}), 400
+    
+    # Содержимое уже на сервере - загружать нечего
+    existing = find_by_hash(machine_id, filename, data.get('sha256'))
+    if existing:
+        return duplicate_response(existing)
+    
+    upload_id = uuid.uuid4().hex
+    save_upload_session(upload_id, {
+        'machine_id': machine_id,
+        'filename': filename,
+        'size': size,
+        'sha256': data.get('sha256'),
+        'timestamp': data.get('timestamp', datetime.datetime.now().isoformat()),
+        'completed': None,
+    })
+    (SESSIONS_DIR / f"{upload_id}.part").touch()
+    return jsonify({'upload_id': upload_id, 'offset': 0})
+
+@app.route('/upload/sessions/<upload_id>', methods=['GET'])
+def upload_session_status(upload_id):
+    """Сколько байт уже принято - с этого места клиент продолжает"""
+    session = load_upload_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    part = SESSIONS_DIR / f"{upload_id}.part"
+    offset = session['size'] if session['completed'] else part.stat().st_size
+    return jsonify({
+        'upload_id': upload_id,
+        'offset': offset,
+        'size': session['size'],
+        'completed': session['completed'],
+    })
+
+@app.route('/upload/sessions/<upload_id>', methods=['PUT'])
+def upload_session_chunk(upload_id):
+    """Прием очередного куска по смещению offset"""
+    session = load_upload_session(upload_id)
+    if session is None or session['completed']:
+        return jsonify({'error': 'Unknown upload'}), 404
+    offset = request.args.get('offset', type=int)
+    part = SESSIONS_DIR / f"{upload_id}.part"
+    touch_machine(session['machine_id'])
+    
+    with get_append_lock(part):
+        size = part.stat().st_size
+        if offset != size:
+            return jsonify({'error': 'Offset mismatch', 'offset': size}), 409
+        with open(part, 'ab') as f:
+            shutil.copyfileobj(request.stream, f, APPEND_BUFFER_SIZE)
+        size = part.stat().st_size
+    
+    return jsonify({'offset': size})
+
+@app.route('/upload/sessions/<upload_id>/finalize', methods=['POST'])
+def upload_session_finalize(upload_id):
+    """Проверка размера и контрольной суммы, перенос файла в папку машины"""
+    session = load_upload_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Unknown upload'}), 404
+    machine_id = session['machine_id']
+    
+    part = SESSIONS_DIR / f"{upload_id}.part"
+    with get_append_lock(part):
+        # Повторный finalize (ответ потерялся) - файл уже на месте
+        if not session['completed']:
+            size = part.stat().st_size
+            if size != session['size']:
+                return jsonify({'error': 'Incomplete upload', 'offset': size}), 409
+            
+            expected = (request.get_json(silent=True) or {}).get('sha256') or session['sha256']
+            sha256 = file_sha256(part)
+            if expected and sha256 != expected:
+                part.unlink(missing_ok=True)
+                (SESSIONS_DIR / f"{upload_id}.json").unlink(missing_ok=True)
+                return jsonify({'error': 'Checksum mismatch'}), 400
+            
+            # Параллельная загрузка того же файла успела раньше
+            existing = find_by_hash(machine_id, session['filename'], sha256)
+            if existing:
+                part.unlink(missing_ok=True)
+                (SESSIONS_DIR / f"{upload_id}.json").unlink(missing_ok=True)
+                return duplicate_response(existing)
+            
+            machine_folder = UPLOAD_DIR / machine_id
+            machine_folder.mkdir(exist_ok=True)
+            filename = f"{session['timestamp'].replace(':', '-')}_{session['filename']}"
+            part.replace(machine_folder / filename)
+            add_to_hash_index(machine_id, session['filename'], sha256, machine_folder / filename)
+            index_recording(machine_folder / filename)
+            session['completed'] = filename
+            save_upload_session(upload_id, session)
+            print(f"[UPLOAD] {machine_id}: {filename} ({size/(1024*1024):.2f} MB, resumable)")
+    
+    discard_partial_append(UPLOAD_DIR / machine_id, session['filename'])
+    filename = session['completed']
+    file_size = session['size']
+    return jsonify({
+        'status': 'success',
+        'message': 'Файл загружен',
+        'machine_id': machine_id,
+        'filename': filename,
+        'size_mb': round(file_size / (1024*1024), 2)
+    })
+
 @app.route('/api/machines')
 def api_machines():
-    """API: список машин"""
-    machines = {}
+    """API: список машин. ETag - версия состояния: без изменений - 304"""
+    etag = dashboard_etag()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        machines = {}
+        for machine_id, count, total_size, last_upload in query_recordings(
+                "SELECT machine_id, COUNT(*), SUM(size), MAX(mtime) FROM recordings GROUP BY machine_id"):
+            machines[machine_id] = {
+                'video_count': count,
+                'total_size': total_size,
+                'last_upload': datetime.datetime.fromtimestamp(last_upload).isoformat(),
+                'online': machine_id in machines_online
+            }
+        response = jsonify(machines)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/events')
+def api_events():
+    """Server-Sent Events для дашборда: machine - изменилась карточка машины,
+    resync - перечитать /api/machines (первое подключение, перезапуск
+    сервера или пропущено больше событий, чем хранится)"""
+    epoch, _, last_seq = request.headers.get('Last-Event-ID', '').partition('-')
     
-    if UPLOAD_DIR.exists():
-        for machine_folder in UPLOAD_DIR.iterdir():
-            if machine_folder.is_dir():
-                machine_id = machine_folder.name
-                videos = list(machine_folder.glob('*.mp4'))
-                total_size = sum(video.stat().st_size for video in videos)
-                
-                machines[machine_id] = {
-                    'video_count': len(videos),
-                    'total_size': total_size,
-                    'last_upload': max([v.stat().st_mtime for v in videos]).isoformat() if videos else None
-                }
+    def generate():
+        seq = int(last_seq) if epoch == DASHBOARD_EPOCH and last_seq.isdigit() else None
+        yield 'retry: 5000\n\n'
+        while True:
+            with dashboard_condition:
+                if seq is not None:
+                    dashboard_condition.wait_for(lambda: dashboard_seq != seq, SSE_KEEPALIVE)
+                current = dashboard_seq
+                if seq is None or (seq != current and (not dashboard_events or dashboard_events[0][0] > seq + 1)):
+                    pending = [(current, 'resync', '{}')]
+                else:
+                    pending = [event for event in dashboard_events if event[0] > seq]
+            if not pending:
+                # Комментарий держит соединение через прокси
+                yield ': keepalive\n\n'
+            for event_seq, name, data in pending:
+                yield f'id: {DASHBOARD_EPOCH}-{event_seq}\nevent: {name}\ndata: {data}\n\n'
+            seq = current
     
-    return jsonify(machines)
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+VIDEOS_PAGE_SIZE = 100
+VIDEOS_PAGE_MAX = 500
+
+def parse_time_arg(value: str) -> float:
+    """Время из параметра запроса: unix-время или ISO (2024-01-01T10:00)"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+def encode_cursor(start_time: float, filename: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([start_time, filename]).encode()).decode()
+
+def decode_cursor(cursor: str):
+    start_time, filename = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return float(start_time), str(filename)
 
 @app.route('/api/videos/<machine_id>')
 def api_videos(machine_id):
-    """API: список видео для машины"""
-    machine_folder = UPLOAD_DIR / machine_id
+    """API: страница видео машины, от новых к старым.
     
-    if not machine_folder.exists():
-        return jsonify([])
+    ?since=&until= - начало записи в интервале [since, until), ?limit= -
+    размер страницы, ?cursor= - next_cursor предыдущей страницы. Страница
+    читается по индексу (machine_id, start_time, filename) от курсора,
+    поэтому не зависит от числа записей машины.
+    """
+    conditions = ["machine_id = ?"]
+    params = [machine_id]
+    try:
+        limit = min(max(int(request.args.get('limit', VIDEOS_PAGE_SIZE)), 1), VIDEOS_PAGE_MAX)
+        if request.args.get('since'):
+            conditions.append("start_time >= ?")
+            params.append(parse_time_arg(request.args['since']))
+        if request.args.get('until'):
+            conditions.append("start_time < ?")
+            params.append(parse_time_arg(request.args['until']))
+        if request.args.get('cursor'):
+            conditions.append("(start_time, filename) < (?, ?)")
+            params.extend(decode_cursor(request.args['cursor']))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Bad limit, since, until or cursor'}), 400
+    
+    rows = query_recordings(
+        "SELECT filename, size, mtime, start_time, duration, codec, width, height FROM recordings "
+        f"WHERE {' AND '.join(conditions)} ORDER BY start_time DESC, filename DESC LIMIT ?",
+        params + [limit + 1])
     
     videos = []
-    for video_file in sorted(machine_folder.glob('*.mp4'), reverse=True):
+    for filename, size, mtime, start_time, duration, codec, width, height in rows[:limit]:
         videos.append({
-            'filename': video_file.name,
-            'url': f'/video/{machine_id}/{video_file.name}',
-            'timestamp': datetime.datetime.fromtimestamp(video_file.stat().st_mtime).strftime('%Y-%m-%d %H:%M'),
-            'size_mb': round(video_file.stat().st_size / (1024 * 1024), 2)
+            'filename': filename,
+            'url': f'/video/{machine_id}/{filename}',
+            'timestamp': datetime.datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M'),
+            'start': datetime.datetime.fromtimestamp(start_time).isoformat(timespec='seconds'),
+            'size_mb': round(size / (1024 * 1024), 2),
+            'duration': round(duration, 1) if duration else None,
+            'codec': codec,
+            'width': width,
+            'height': height
         })
     
-    return jsonify(videos)
+    # Есть еще записи - курсор указывает на последнюю отданную
+    next_cursor = encode_cursor(rows[limit - 1][3], rows[limit - 1][0]) if len(rows) > limit else None
+    return jsonify({'videos': videos, 'next_cursor': next_cursor})
 
 @app.route('/video/<machine_id>/<filename>')
 def serve_video(machine_id, filename):
@@ -292,6 +991,8 @@ def serve_video(machine_id, filename):
     video_path = UPLOAD_DIR / machine_id / filename
     
     if not video_path.exists():
+        # Файл удалили с диска - убираем и из индекса
+        forget_recording(machine_id, filename)
         return jsonify({'error': 'Video not found'}), 404
     
     return send_from_directory(str(video_path.parent), filename, mimetype='video/mp4')